@@ -0,0 +1,115 @@
+"""Subject checks shared by the afni subject cli scripts.
+
+Both afni_task_subj.py and afni_resting_subj.py require fMRIprep
+output before scheduling a subject, and check the same AFNI
+pre-processing output when the user specifies an output location.
+Patterns are compiled once per run, and each subject directory
+is listed once.
+"""
+import os
+import re
+from func_processing.cli._discover import list_files
+
+
+def prep_pattern(task, tplflow_str):
+    """Compile pattern for required fMRIprep output.
+
+    Parameters
+    ----------
+    task : str
+        BIDS task string (task-test)
+    tplflow_str : str
+        template_flow identifier string
+
+    Returns
+    -------
+    re.Pattern
+        groups "anat" (preprocessed T1w), "func" (preprocessed bold)
+    """
+    return re.compile(
+        rf"(?P<anat>.*_{re.escape(tplflow_str)}_desc-preproc_T1w\.nii\.gz$)"
+        rf"|(?P<func>.*{re.escape(task)}.*{re.escape(tplflow_str)}"
+        r"_desc-preproc_bold\.nii\.gz$)"
+    )
+
+
+def output_pattern(sess, task):
+    """Compile pattern for AFNI pre-processing output.
+
+    Parameters
+    ----------
+    sess : str
+        BIDS session string (ses-S1)
+    task : str
+        BIDS task string (task-test)
+
+    Returns
+    -------
+    re.Pattern
+        groups "wme" (WM eroded mask), "intx" (intersection mask),
+        "scaled" (scaled run-1 bold)
+    """
+    return re.compile(
+        r"(?P<wme>.*desc-WMe_mask\.nii\.gz$)"
+        rf"|(?P<intx>.*{re.escape(sess)}_{re.escape(task)}.*desc-intersect_mask"
+        r"\.nii\.gz$)"
+        rf"|(?P<scaled>.*{re.escape(sess)}_{re.escape(task)}_run-1.*desc-scaled_bold"
+        r"\.nii\.gz$)"
+    )
+
+
+def has_prep_output(prep_pat, prep_dir, subj, sess):
+    """Determine whether subject has the required fMRIprep output.
+
+    Anat is written to sub-1234/anat when multiple sessions exist,
+    so both anat locations are listed.
+
+    Parameters
+    ----------
+    prep_pat : re.Pattern
+        output of prep_pattern
+    prep_dir : str
+        /path/to/project_dir/derivatives/fmriprep
+    subj : str
+        BIDS subject string (sub-1234)
+    sess : str
+        BIDS session string (ses-S1)
+
+    Returns
+    -------
+    bool
+        True if both anat and func output exist
+    """
+    prep_files = list_files(
+        os.path.join(prep_dir, subj, "anat"),
+        os.path.join(prep_dir, subj, sess, "anat"),
+        os.path.join(prep_dir, subj, sess, "func"),
+    )
+    prep_found = {x.lastgroup for x in map(prep_pat.match, prep_files) if x}
+    return "anat" in prep_found and "func" in prep_found
+
+
+def find_output(out_pat, afni_final, subj, sess):
+    """Find which AFNI pre-processing output exists for subject.
+
+    Parameters
+    ----------
+    out_pat : re.Pattern
+        output of output_pattern
+    afni_final : str
+        /path/to/project_dir/derivatives/afni, or out_dir
+    subj : str
+        BIDS subject string (sub-1234)
+    sess : str
+        BIDS session string (ses-S1)
+
+    Returns
+    -------
+    set
+        found groups of out_pat, e.g. {"wme", "intx"}
+    """
+    subj_dir = os.path.join(afni_final, subj, sess)
+    out_files = list_files(
+        os.path.join(subj_dir, "anat"), os.path.join(subj_dir, "func")
+    )
+    return {x.lastgroup for x in map(out_pat.match, out_files) if x}
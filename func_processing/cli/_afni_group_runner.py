@@ -0,0 +1,54 @@
+"""Group job for cli/afni_resting_group.py and cli/afni_task_group.py.
+
+Submitted by the submit_jobs of either group cli, runs the resting
+(--seed) or task (--beh-list) group analysis of --group-json-file.
+"""
+from argparse import ArgumentParser
+from func_processing.cli._sbatch import read_params
+from func_processing.workflow import control_afni
+
+
+def get_args():
+    """Get and parse arguments."""
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--task", type=str, required=True)
+    parser.add_argument("--afni-dir", type=str, required=True)
+    parser.add_argument("--group-dir", type=str, required=True)
+    parser.add_argument("--group-json-file", type=str, required=True)
+    parser.add_argument("--blur", action="store_true")
+    analysis = parser.add_mutually_exclusive_group(required=True)
+    analysis.add_argument("--seed", type=str)
+    analysis.add_argument("--beh-list", type=str, nargs=2)
+    parser.add_argument("--sess", type=str)
+    return parser
+
+
+def main():
+    """Run the requested group analysis."""
+    args = get_args().parse_args()
+    group_data = read_params(args.group_json_file)
+
+    if args.seed:
+        group_data = control_afni.control_resting_group(
+            args.seed,
+            args.task,
+            args.afni_dir,
+            args.group_dir,
+            group_data,
+            args.blur,
+        )
+    else:
+        group_data = control_afni.control_task_group(
+            args.beh_list,
+            args.task,
+            args.sess,
+            args.afni_dir,
+            args.group_dir,
+            group_data,
+            args.blur,
+        )
+    print(f"Job finished with group_data : \n{group_data}")
+
+
+if __name__ == "__main__":
+    main()
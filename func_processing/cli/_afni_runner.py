@@ -0,0 +1,105 @@
+"""Job array task for cli/afni_task_subj.py.
+
+Submitted by afni_task_subj.submit_jobs, each array task selects its
+subject from --subj-params-file via SLURM_ARRAY_TASK_ID. The subject is then
+taken from fMRIprep output through deconvolution. Finally, clean up,
+and move relevant files to --afni-final.
+"""
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser
+from func_processing.cli._joblog import log_to_local
+from func_processing.cli._move import move_tree
+from func_processing.cli._sbatch import array_task
+from func_processing.workflow import control_afni
+
+
+def get_args():
+    """Get and parse arguments."""
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--subj-params-file", type=str, required=True)
+    parser.add_argument("--log-dir", type=str, required=True)
+    parser.add_argument("--prep-dir", type=str, required=True)
+    parser.add_argument("--afni-dir", type=str, required=True)
+    parser.add_argument("--afni-final", type=str, required=True)
+    parser.add_argument("--dset-dir", type=str, required=True)
+    parser.add_argument("--sess", type=str, required=True)
+    parser.add_argument("--task", type=str, required=True)
+    parser.add_argument("--tplflow-str", type=str, required=True)
+    parser.add_argument("--dur", type=str, required=True)
+    parser.add_argument("--blur", action="store_true")
+    parser.add_argument("--keep-interm", action="store_true")
+    return parser
+
+
+def main():
+    """Process the subject of this array task."""
+    args = get_args().parse_args()
+    afni_dir = args.afni_dir
+    kp_interm = args.keep_interm
+    sess = args.sess
+    task = args.task
+
+    # get subject for array task
+    subj_params = array_task(args.subj_params_file)
+    subj = subj_params["subj"]
+
+    # keep verbose afni output on node-local disk
+    log_to_local(os.path.join(args.log_dir, f"out_{subj}.txt"))
+
+    afni_data = control_afni.control_preproc(
+        args.prep_dir,
+        afni_dir,
+        subj,
+        sess,
+        task,
+        args.tplflow_str,
+        args.blur,
+    )
+
+    if subj_params["do_decon"]:
+        afni_data = control_afni.control_deconvolution(
+            afni_data,
+            afni_dir,
+            args.dset_dir,
+            subj,
+            sess,
+            task,
+            args.dur,
+            subj_params["decon_plan"],
+            kp_interm,
+        )
+        print(f"Finished {subj}/{sess}/{task} with: \n {afni_data}")
+
+    # clean up
+    if not kp_interm:
+        shutil.rmtree(os.path.join(afni_dir, subj, sess, "sbatch_out"))
+        clean_dir = os.path.join(afni_dir, subj, sess)
+        clean_list = [
+            "preproc_bold",
+            "smoothed_bold",
+            "nuissance_bold",
+            "probseg",
+            "preproc_T1w",
+            "minval_mask",
+            "GMe_mask",
+        ]
+
+        # single walk of clean_dir, overlap removals on the shared fs
+        clean_suffix = tuple(f"{x}.nii.gz" for x in clean_list)
+        clean_files = [
+            os.path.join(h_root, h_file)
+            for h_root, _, h_files in os.walk(clean_dir)
+            for h_file in h_files
+            if h_file.endswith(clean_suffix)
+        ]
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            list(executor.map(os.remove, clean_files))
+
+    # move important files to /home/data, renamed when on the same filesystem
+    move_tree(os.path.join(afni_dir, subj), os.path.join(args.afni_final, subj))
+
+
+if __name__ == "__main__":
+    main()
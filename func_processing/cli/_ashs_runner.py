@@ -0,0 +1,44 @@
+"""Job array task for cli/ashs.py.
+
+Submitted by ashs.submit_jobs, each array task selects its subject
+from --subj-params-file via SLURM_ARRAY_TASK_ID, and then governs the child
+ashs jobs (ashs1234) of the subject.
+"""
+from argparse import ArgumentParser
+from func_processing.cli._sbatch import array_task
+from func_processing.workflow import control_ashs
+
+
+def get_args():
+    """Get and parse arguments."""
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--subj-params-file", type=str, required=True)
+    parser.add_argument("--atlas-dir", type=str, required=True)
+    parser.add_argument("--sing-img", type=str, required=True)
+    parser.add_argument("--atlas-str", type=str, required=True)
+    return parser
+
+
+def main():
+    """Segment the hippocampus of the subject of this array task."""
+    args = get_args().parse_args()
+
+    # get subject for array task
+    subj_params = array_task(args.subj_params_file)
+
+    control_ashs.control_hipseg(
+        subj_params["t1-dir"],
+        subj_params["t2-dir"],
+        subj_params["subj-deriv"],
+        subj_params["subj-work"],
+        args.atlas_dir,
+        args.sing_img,
+        subj_params["subj"],
+        subj_params["t1-file"],
+        subj_params["t2-file"],
+        args.atlas_str,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""Filesystem discovery helpers for the cli scripts.
+
+Walk BIDS-style derivative trees once via os.scandir, rather
+than issuing a recursive glob for every subject and file type.
+Subject indices of the raw dataset are reused across runs and
+cli scripts via the discovery cache (index_dset).
+"""
+import os
+import json
+import hashlib
+import tempfile
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+def index_tree(root, depth=4):
+    """Walk <root> once, yielding every directory entry.
+
+    Traversal is depth-first via os.scandir, and the dirent type
+    is used to determine directories (no additional stat calls).
+
+    Parameters
+    ----------
+    root : str
+        /path/to/start/walk
+    depth : int
+        number of directory levels beneath <root> to descend
+
+    Yields
+    ------
+    (name, path, is_dir) : tuple
+        entry name, entry path, whether entry is a directory
+    """
+    stack = [(root, 1)]
+    while stack:
+        h_dir, h_depth = stack.pop()
+        try:
+            with os.scandir(h_dir) as h_iter:
+                for entry in h_iter:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    yield (entry.name, entry.path, is_dir)
+                    if is_dir and h_depth < depth:
+                        stack.append((entry.path, h_depth + 1))
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+
+
+def iter_subjects(root):
+    """Yield BIDS subject directories directly within <root>.
+
+    Names are yielded in directory order as <root> is read, so
+    callers may begin checking subjects before the listing finishes.
+
+    Parameters
+    ----------
+    root : str
+        /path/to/BIDS/dset, or derivatives/<pipeline>
+
+    Yields
+    ------
+    str
+        subject directory name, e.g. "sub-1234"
+    """
+    for name, _, is_dir in index_tree(root, depth=1):
+        if is_dir and name.startswith("sub-"):
+            yield name
+
+
+def list_subjects(root):
+    """List BIDS subject directories directly within <root>.
+
+    Parameters
+    ----------
+    root : str
+        /path/to/BIDS/dset, or derivatives/<pipeline>
+
+    Returns
+    -------
+    list
+        sorted subject directory names, e.g. ["sub-1234", "sub-1235"]
+    """
+    return sorted(iter_subjects(root))
+
+
+def index_subjects(root, depth=4):
+    """Index all files beneath each subject of <root>.
+
+    Parameters
+    ----------
+    root : str
+        /path/to/BIDS/derivatives/<pipeline>
+    depth : int
+        number of directory levels beneath <root> to descend,
+        e.g. 4 for <root>/sub-1234/ses-A/func/file
+
+    Returns
+    -------
+    subj_index : dict
+        {sub-1234: [/path/to/file, ...]}
+    """
+    subj_index = {}
+    for subj in list_subjects(root):
+        subj_index[subj] = [
+            h_path
+            for _, h_path, h_is_dir in index_tree(
+                os.path.join(root, subj), depth=depth - 1
+            )
+            if not h_is_dir
+        ]
+    return subj_index
+
+
+@functools.lru_cache(maxsize=4096)
+def _list_dir(h_dir):
+    """Return names of files directly within h_dir, read once per process."""
+    return tuple(name for name, _, is_dir in index_tree(h_dir, depth=1) if not is_dir)
+
+
+def list_files(*dir_list):
+    """List files directly within each directory.
+
+    Only the immediate children of each directory are read, allowing
+    callers to expand the literal BIDS prefix (sub-1234/ses-A/func)
+    rather than recursively walking a subject tree. Each directory is
+    read once per process, so checks which revisit a directory (e.g.
+    output then deconvolution checks of func) do not rescan it; the
+    cli scripts check before submitting, and exit.
+
+    Parameters
+    ----------
+    dir_list : str
+        /path/to/dir, missing directories are skipped
+
+    Returns
+    -------
+    list
+        file names found in dir_list
+    """
+    return [name for h_dir in dir_list for name in _list_dir(h_dir)]
+
+
+def _cache_path(cache_key):
+    """Return /path/to/discovery cache file for cache_key."""
+    h_hash = hashlib.sha1(json.dumps(cache_key).encode()).hexdigest()[:16]
+    return os.path.join(
+        os.path.expanduser("~"),
+        ".cache/func_processing",
+        f"discovery_{h_hash}.json",
+    )
+
+
+def read_cache(cache_key):
+    """Return a previous discovery result for cache_key.
+
+    Parameters
+    ----------
+    cache_key : list
+        json-serializable values which determine the discovery result,
+        e.g. ["dset", dset_dir, depth]
+
+    Returns
+    -------
+    dict, None
+        cached discovery result, None when absent, stale or corrupt
+    """
+    try:
+        with open(_cache_path(cache_key)) as jf:
+            h_cache = json.load(jf)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(h_cache, dict) or h_cache.get("key") != cache_key:
+        return None
+    return h_cache.get("result")
+
+
+def write_cache(cache_key, result):
+    """Write discovery result for cache_key, best effort.
+
+    The result is written to a temporary file which then replaces the
+    cache file, so concurrent runs never read a partial cache.
+
+    Parameters
+    ----------
+    cache_key : list
+        json-serializable values which determine the discovery result
+    result : dict
+        discovery result, e.g. subj_dict
+    """
+    cache_file = _cache_path(cache_key)
+    cache_dir = os.path.dirname(cache_file)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        h_fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    except OSError:
+        return
+    try:
+        with os.fdopen(h_fd, "w") as jf:
+            json.dump({"key": cache_key, "result": result}, jf)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+
+
+def _scan_subject(subj_dir, depth):
+    """Return {"dirs": {path: mtime_ns}, "files": [path]} of subj_dir."""
+    subj_dirs = {subj_dir: os.stat(subj_dir).st_mtime_ns}
+    subj_files = []
+    for _, h_path, is_dir in index_tree(subj_dir, depth=depth):
+        if is_dir:
+            subj_dirs[h_path] = os.stat(h_path).st_mtime_ns
+        else:
+            subj_files.append(h_path)
+    return {"dirs": subj_dirs, "files": sorted(subj_files)}
+
+
+def _is_current(subj_entry):
+    """Determine whether no directory of a cached subject has changed."""
+    try:
+        return isinstance(subj_entry["files"], list) and all(
+            os.stat(h_dir).st_mtime_ns == mtime
+            for h_dir, mtime in subj_entry["dirs"].items()
+        )
+    except (OSError, KeyError, TypeError, AttributeError):
+        # directory removed, or malformed entry
+        return False
+
+
+def index_dset(dset_dir, subj_list, depth=3):
+    """Index the files of each subject in dset_dir, reusing previous runs.
+
+    The index is kept in the discovery cache and shared by all cli
+    scripts. A subject is only walked again when the mtime of one of
+    its directories has changed, i.e. when entries were added, removed
+    or renamed beneath it.
+
+    Parameters
+    ----------
+    dset_dir : str
+        /path/to/BIDS/dset
+    subj_list : list
+        subjects to index, e.g. those missing output
+    depth : int
+        number of directory levels beneath each subject to descend,
+        e.g. 3 for sub-1234/ses-A/anat/file
+
+    Returns
+    -------
+    dict
+        {sub-1234: [/path/to/file, ...]}, subjects without a
+        directory in dset_dir are omitted
+    """
+    cache_key = ["dset", dset_dir, depth]
+    dset_index = read_cache(cache_key)
+    if not isinstance(dset_index, dict):
+        dset_index = {}
+
+    def check_subject(subj):
+        """Return (subj, entry, rescanned) of subj."""
+        subj_entry = dset_index.get(subj)
+        if subj_entry and _is_current(subj_entry):
+            return (subj, subj_entry, False)
+        subj_dir = os.path.join(dset_dir, subj)
+        if not os.path.isdir(subj_dir):
+            return (subj, None, bool(subj_entry))
+        return (subj, _scan_subject(subj_dir, depth), True)
+
+    # stats are filesystem bound, overlap them across subjects
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        subj_results = list(executor.map(check_subject, subj_list))
+
+    # update cache for walked subjects only
+    if any(rescanned for _, _, rescanned in subj_results):
+        for subj, subj_entry, rescanned in subj_results:
+            if not rescanned:
+                continue
+            if subj_entry:
+                dset_index[subj] = subj_entry
+            else:
+                dset_index.pop(subj, None)
+        write_cache(cache_key, dset_index)
+    return {
+        subj: subj_entry["files"] for subj, subj_entry, _ in subj_results if subj_entry
+    }
@@ -0,0 +1,72 @@
+"""Job array task for cli/fmriprep.py.
+
+Submitted by fmriprep.submit_jobs, each array task selects its
+subject from --subj-params-file via SLURM_ARRAY_TASK_ID. FreeSurfer and
+fMRIprep are then run for the subject in scratch, and output is
+copied to the project derivatives.
+"""
+import os
+import glob
+import shutil
+from argparse import ArgumentParser
+from func_processing.cli._joblog import log_to_local
+from func_processing.cli._move import move_tree
+from func_processing.cli._sbatch import array_task
+from func_processing.workflow import control_fmriprep
+
+
+def get_args():
+    """Get and parse arguments."""
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--subj-params-file", type=str, required=True)
+    parser.add_argument("--log-dir", type=str, required=True)
+    parser.add_argument("--proj-dir", type=str, required=True)
+    parser.add_argument("--scratch-dir", type=str, required=True)
+    parser.add_argument("--sing-img", type=str, required=True)
+    parser.add_argument("--tplflow-dir", type=str, required=True)
+    parser.add_argument("--fs-license", type=str, required=True)
+    return parser
+
+
+def main():
+    """Process the subject of this array task."""
+    args = get_args().parse_args()
+
+    # get subject for array task
+    subj = array_task(args.subj_params_file)
+
+    # keep verbose fmriprep output on node-local disk
+    log_to_local(os.path.join(args.log_dir, f"out_{subj}.txt"))
+
+    path_dict = control_fmriprep.control_fmriprep(
+        subj,
+        args.proj_dir,
+        args.scratch_dir,
+        args.sing_img,
+        args.tplflow_dir,
+        args.fs_license,
+    )
+
+    # move freesurfer data to project directory
+    move_tree(
+        os.path.join(path_dict["scratch-fsurf"], subj),
+        os.path.join(path_dict["proj-deriv"], "freesurfer", subj),
+    )
+
+    # move fmriprep data (sub-1234, sub-1234.html) to project directory
+    subj_fprep = os.path.join(path_dict["scratch-fprep"], subj)
+    for h_src in glob.glob(f"{subj_fprep}*"):
+        h_dst = os.path.join(
+            path_dict["proj-deriv"], "fmriprep", os.path.basename(h_src)
+        )
+        if os.path.isdir(h_src):
+            move_tree(h_src, h_dst)
+        else:
+            shutil.move(h_src, h_dst)
+
+    # turn out the lights
+    shutil.rmtree(path_dict["scratch-work"])
+
+
+if __name__ == "__main__":
+    main()
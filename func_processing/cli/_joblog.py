@@ -0,0 +1,75 @@
+"""Keep verbose job logging on node-local storage.
+
+AFNI and fMRIprep write continuously to stdout/err, which sbatch
+otherwise streams to slurm_dir on the shared filesystem. Job
+scripts instead redirect both to $SLURM_TMPDIR, and the log is
+gzipped to slurm_dir in one write when the job exits, including
+when Slurm terminates it (time limit, scancel) via SIGTERM.
+"""
+import os
+import sys
+import gzip
+import atexit
+import shutil
+import signal
+import tempfile
+
+
+def _archive(tmp_log, log_path, std_fds):
+    """Restore stdout/err, compress tmp_log to log_path."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    for h_fd, h_saved in zip((1, 2), std_fds):
+        os.dup2(h_saved, h_fd)
+        os.close(h_saved)
+    with open(tmp_log, "rb") as h_src, gzip.open(log_path, "wb") as h_dst:
+        shutil.copyfileobj(h_src, h_dst)
+    os.remove(tmp_log)
+    print(f"Job log written to {log_path}")
+
+
+def log_to_local(log_path):
+    """Redirect stdout/err of this process and its children to node-local disk.
+
+    Output, including that of subprocesses, is written to a uniquely
+    named file in $SLURM_TMPDIR (or $TMPDIR) until the interpreter exits
+    or receives SIGTERM, when it is compressed to <log_path>.gz. Jobs
+    sharing a node and log name therefore never share a local log.
+
+    Parameters
+    ----------
+    log_path : str
+        /path/to/slurm_dir/out_sub-1234.txt
+
+    Returns
+    -------
+    str
+        path to the node-local log
+    """
+    tmp_dir = os.environ.get("SLURM_TMPDIR") or os.environ.get("TMPDIR") or "/tmp"
+    log_name, log_ext = os.path.splitext(os.path.basename(log_path))
+    h_fd, tmp_log = tempfile.mkstemp(dir=tmp_dir, prefix=f"{log_name}_", suffix=log_ext)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    std_fds = [os.dup(1), os.dup(2)]
+    os.dup2(h_fd, 1)
+    os.dup2(h_fd, 2)
+    os.close(h_fd)
+
+    # archive once, at exit or on SIGTERM, which does not run atexit
+    archived = []
+
+    def archive():
+        if not archived:
+            archived.append(True)
+            _archive(tmp_log, f"{log_path}.gz", std_fds)
+
+    def archive_on_term(signum, frame):
+        archive()
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+    atexit.register(archive)
+    signal.signal(signal.SIGTERM, archive_on_term)
+    return tmp_log
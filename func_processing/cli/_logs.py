@@ -0,0 +1,100 @@
+"""Load logs/completed_preprocessing.tsv for the cli scripts.
+
+The tsv log is mirrored to a sibling feather file, which is
+read instead of re-parsing the tsv while the tsv is unchanged, i.e.
+while its mtime and size match those recorded in the feather file.
+Feather support requires pyarrow, the tsv is read directly
+when it is not available. Callers may request a subset of columns,
+which are the only columns parsed from the feather file.
+"""
+import os
+import tempfile
+
+# schema metadata key holding the stat of the tsv a cache was written from
+_TSV_STAT = b"completed_preprocessing.tsv"
+
+
+def _stat_key(log_tsv):
+    """Return mtime_ns and size of log_tsv, identifying its contents."""
+    tsv_stat = os.stat(log_tsv)
+    return f"{tsv_stat.st_mtime_ns}:{tsv_stat.st_size}".encode()
+
+
+def _write_feather(df_log, log_feather, stat_key):
+    """Write df_log to log_feather, best effort.
+
+    The stat_key of the tsv that df_log was read from is stored in
+    the schema metadata. The frame is written to a temporary file which
+    then replaces the feather file, so concurrent runs never read a
+    partial cache.
+    """
+    import pyarrow
+    from pyarrow import feather
+
+    try:
+        h_fd, tmp_file = tempfile.mkstemp(
+            dir=os.path.dirname(log_feather), suffix=".tmp"
+        )
+    except OSError:
+        return
+    try:
+        log_table = pyarrow.Table.from_pandas(df_log, preserve_index=False)
+        log_table = log_table.replace_schema_metadata(
+            {**(log_table.schema.metadata or {}), _TSV_STAT: stat_key}
+        )
+        with os.fdopen(h_fd, "wb") as h_file:
+            feather.write_feather(log_table, h_file)
+        os.replace(tmp_file, log_feather)
+    except Exception:
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+
+
+def load_log(log_dir, columns=None):
+    """Read completed_preprocessing log.
+
+    Parameters
+    ----------
+    log_dir : str
+        /path/to/func_processing/logs
+    columns : list, optional
+        column names to read, e.g. ["subjID", "wme_mask"], all
+        columns are read when None
+
+    Returns
+    -------
+    df_log : pandas.DataFrame
+        contents of completed_preprocessing.tsv
+    """
+    # import on use, keeps pandas out of cli start-up and --help
+    import pandas as pd
+
+    log_tsv = os.path.join(log_dir, "completed_preprocessing.tsv")
+    log_feather = os.path.join(log_dir, "completed_preprocessing.feather")
+
+    # without pyarrow there is no cache, parse only needed columns
+    try:
+        import pyarrow
+    except ImportError:
+        return pd.read_csv(log_tsv, sep="\t", usecols=columns)
+
+    # stat the log before reading it, so a log updated while the cache
+    # is refreshed does not match the cache
+    stat_key = _stat_key(log_tsv)
+
+    # use cache when it was written from the current log, fall back to the
+    # log when the cache is missing, stale, truncated, or otherwise unreadable
+    try:
+        with pyarrow.ipc.open_file(log_feather) as h_reader:
+            cache_key = (h_reader.schema.metadata or {}).get(_TSV_STAT)
+        if cache_key == stat_key:
+            return pd.read_feather(log_feather, columns=columns)
+    except Exception:
+        pass
+
+    # refresh cache with all columns, for other callers
+    df_log = pd.read_csv(log_tsv, sep="\t")
+    _write_feather(df_log, log_feather, stat_key)
+    return df_log[columns] if columns else df_log
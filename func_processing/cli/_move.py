@@ -0,0 +1,63 @@
+"""Move finished subject output from scratch to the project.
+
+Output is renamed in place when scratch and project share a
+filesystem, so no data are copied. Otherwise files are streamed
+by rsync, and sources removed as they land so an interrupted
+move can be resumed.
+"""
+import os
+import errno
+import shutil
+import subprocess
+
+
+def _rename_tree(src, dst):
+    """Rename src to dst, merging into dst when it already exists."""
+    try:
+        os.rename(src, dst)
+        return
+    except OSError as err:
+        if err.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+            raise
+
+    # dst holds previous sessions, rename each file into place
+    for h_root, _, h_files in os.walk(src):
+        h_dst = os.path.join(dst, os.path.relpath(h_root, src))
+        os.makedirs(h_dst, exist_ok=True)
+        for h_file in h_files:
+            os.replace(os.path.join(h_root, h_file), os.path.join(h_dst, h_file))
+    shutil.rmtree(src)
+
+
+def move_tree(src, dst):
+    """Move directory src to dst, merging with existing dst content.
+
+    Parameters
+    ----------
+    src : str
+        /path/to/scratch/sub-1234
+    dst : str
+        /path/to/project/derivatives/<pipeline>/sub-1234
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        _rename_tree(src, dst)
+        return
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+
+    # different filesystems, files already renamed remain in dst
+    subprocess.run(
+        [
+            "rsync",
+            "-a",
+            "--whole-file",
+            "--inplace",
+            "--remove-source-files",
+            f"{src}/",
+            f"{dst}/",
+        ],
+        check=True,
+    )
+    shutil.rmtree(src)
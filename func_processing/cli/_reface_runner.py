@@ -0,0 +1,39 @@
+"""Job array task for cli/reface.py.
+
+Submitted by reface.submit_jobs, each array task selects its subject
+from --subj-params-file via SLURM_ARRAY_TASK_ID, and then re/defaces the
+T1w file of the subject.
+"""
+from argparse import ArgumentParser
+from func_processing.cli._sbatch import array_task
+from func_processing.workflow import control_reface
+
+
+def get_args():
+    """Get and parse arguments."""
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--subj-params-file", type=str, required=True)
+    parser.add_argument("--proj-dir", type=str, required=True)
+    parser.add_argument("--method", type=str, required=True)
+    return parser
+
+
+def main():
+    """Re/deface the subject of this array task."""
+    args = get_args().parse_args()
+
+    # get subject for array task
+    subj_params = array_task(args.subj_params_file)
+
+    msg_out = control_reface.control_reface(
+        subj_params["subj"],
+        subj_params["sess"],
+        subj_params["anat"],
+        args.proj_dir,
+        args.method,
+    )
+    print(msg_out)
+
+
+if __name__ == "__main__":
+    main()
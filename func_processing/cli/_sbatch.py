@@ -0,0 +1,375 @@
+"""Submit work to SLURM for the cli scripts.
+
+sbatch is resolved once and executed directly. Submissions
+refused by a busy or unreachable controller are retried with
+exponential backoff, rather than pausing before every submission.
+All cli scripts submit a committed runner (cli/_*_runner.py) via
+submit, so lab scheduling options are shared through SBATCH_DEFAULTS.
+Per-subject submission loops wait on their pending jobs via
+wait_for_queue before a batch, submit the batch without pausing, and
+then confirm all of its jobs were accepted via check_jobs.
+Submissions are --parsable, job_id returns the id for reporting or
+chaining later jobs (--dependency=afterok:<id>).
+"""
+import os
+import json
+import time
+import shlex
+import shutil
+import random
+from datetime import datetime
+
+# resolve once, sbatch is then executed directly rather than via a shell
+_SBATCH = shutil.which("sbatch") or "sbatch"
+_SQUEUE = shutil.which("squeue") or "squeue"
+_SACCT = shutil.which("sacct") or "sacct"
+
+# lab partition/account, and per-job memory (MB)
+SBATCH_DEFAULTS = {
+    "partition": "IB_44C_512G",
+    "account": "iacc_madlab",
+    "qos": "pq_madlab",
+    "mem": "4000",
+}
+
+# controller errors which are worth retrying
+_TRANSIENT = (b"Socket timed out", b"Resource temporarily unavailable")
+
+
+def run_sbatch(sbatch_args, retries=3):
+    """Run sbatch --parsable, retrying on transient controller errors.
+
+    Parameters
+    ----------
+    sbatch_args : list
+        sbatch options, e.g. ["--array=0-7", "--wrap=<command>"]
+    retries : int
+        number of retries after the first attempt, waiting 1, 2, 4 ...
+        seconds between attempts
+
+    Returns
+    -------
+    h_out, h_err : bytes
+        stdout (b"1234", see job_id), stderr of sbatch submission
+    """
+    # import on use, as for pandas in cli._logs
+    import subprocess
+
+    for attempt in range(retries + 1):
+        sbatch_response = subprocess.run(
+            [_SBATCH, "--parsable"] + sbatch_args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=False,
+        )
+        if (
+            sbatch_response.returncode == 0
+            or attempt == retries
+            or not any(x in sbatch_response.stderr for x in _TRANSIENT)
+        ):
+            break
+        time.sleep(2**attempt)
+    return (sbatch_response.stdout, sbatch_response.stderr)
+
+
+def job_id(h_out):
+    """Get the job id from sbatch --parsable stdout.
+
+    Parameters
+    ----------
+    h_out : bytes
+        stdout of sbatch submission, b"1234" or b"1234;cluster"
+
+    Returns
+    -------
+    str or None
+        job id, None when submission failed
+    """
+    h_id = h_out.decode().strip().split(";")[0]
+    return h_id or None
+
+
+def report_submission(h_out, h_err):
+    """Print the job id of a submission, or sbatch stderr when it failed.
+
+    Parameters
+    ----------
+    h_out, h_err : bytes
+        stdout, stderr of sbatch submission
+
+    Returns
+    -------
+    str or None
+        job id, None when submission failed
+    """
+    h_id = job_id(h_out)
+    if h_id:
+        print(f"Submitted job {h_id}")
+    else:
+        print(f"ERROR: sbatch submission failed:\n{h_err.decode().strip()}")
+    return h_id
+
+
+def wait_for_queue(job_name, max_pending=2, timeout=2700):
+    """Wait until few jobs of a workflow are pending.
+
+    Submits immediately when the queue is clear, otherwise backs off
+    exponentially (30 s doubling to 30 min) with jitter, so several
+    submitting users do not probe the controller in step. Only the
+    user's pending jobs named job_name are counted, so unrelated
+    pending work does not hold up the workflow.
+
+    Parameters
+    ----------
+    job_name : str
+        sbatch job name of the workflow, e.g. "pAshs"
+    max_pending : int
+        number of pending jobs tolerated before waiting
+    timeout : int
+        seconds to wait before giving up on this batch, less than
+        the interval of scheduled submitters so runs do not pile up
+
+    Returns
+    -------
+    bool
+        True when the batch may be submitted, False after timeout
+    """
+    import subprocess
+
+    start_time = time.monotonic()
+    attempt = 0
+    while True:
+        try:
+            squeue_response = subprocess.run(
+                [
+                    _SQUEUE,
+                    "--me",
+                    "-h",
+                    "-t",
+                    "PENDING",
+                    f"--name={job_name}",
+                    "-o",
+                    "%i",
+                ],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                check=False,
+            )
+        except FileNotFoundError:
+            return True
+        if len(squeue_response.stdout.splitlines()) <= max_pending:
+            return True
+
+        remain = timeout - (time.monotonic() - start_time)
+        if remain <= 0:
+            return False
+        time.sleep(min(30 * 2**attempt, 1800, remain) + random.uniform(0, 5))
+        attempt += 1
+
+
+# states of an accepted job which has not failed
+_ACTIVE = ("PENDING", "RUNNING", "CONFIGURING", "COMPLETING")
+
+
+def _job_states(query_cmd):
+    """Run squeue/sacct query_cmd, return {job_id: state}, None if missing.
+
+    Array tasks (1234_0, 1234_[1-7]) report under their array job,
+    the first state which is not active is kept.
+    """
+    import subprocess
+
+    try:
+        query_response = subprocess.run(
+            query_cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=False,
+        )
+    except FileNotFoundError:
+        return None
+    job_state = {}
+    for line in query_response.stdout.decode().splitlines():
+        if not line:
+            continue
+        h_id, state = line.split("|", 1)
+        h_id = h_id.split("_")[0]
+        if job_state.get(h_id, "PENDING") in _ACTIVE:
+            job_state[h_id] = state.split()[0]
+    return job_state
+
+
+def check_jobs(h_out_list, retries=3):
+    """Report submitted jobs which are not pending or running.
+
+    Freshly submitted jobs are queried from the controller via squeue,
+    as slurmdbd may take a few seconds to record them. Jobs no longer
+    queued, e.g. failed at once, are then queried via sacct, retrying
+    briefly before they are reported as not found. For job arrays, any
+    task which is not active is reported.
+
+    Parameters
+    ----------
+    h_out_list : list
+        stdout of each sbatch submission, see job_id
+    retries : int
+        number of sacct retries for jobs missing from both queries,
+        waiting 1, 2, 4 ... seconds between attempts
+
+    Returns
+    -------
+    dict
+        {job_id: state} of jobs which were not found, or are neither
+        pending nor running
+    """
+    job_list = [x for x in map(job_id, h_out_list) if x]
+    if not job_list:
+        return {}
+    job_state = _job_states([_SQUEUE, "-h", "-j", ",".join(job_list), "-o", "%i|%T"])
+    if job_state is None:
+        job_state = {}
+
+    # jobs no longer queued are found in accounting, once recorded
+    for attempt in range(retries + 1):
+        h_missing = [x for x in job_list if x not in job_state]
+        if not h_missing:
+            break
+        sacct_state = _job_states(
+            [_SACCT, "-j", ",".join(h_missing), "-X", "-n", "-P", "-o", "JobID,State"]
+        )
+        if sacct_state is None:
+            # no accounting, only report what the controller knows
+            job_list = [x for x in job_list if x in job_state]
+            break
+        job_state.update(sacct_state)
+        if attempt < retries and any(x not in job_state for x in h_missing):
+            time.sleep(2**attempt)
+
+    bad_jobs = {
+        h_id: job_state.get(h_id, "NOT FOUND")
+        for h_id in job_list
+        if job_state.get(h_id) not in _ACTIVE
+    }
+    for h_id, state in bad_jobs.items():
+        print(f"WARNING: job {h_id} is {state}")
+    return bad_jobs
+
+
+def make_slurm_dir(parent, prefix):
+    """Make a directory for the sbatch stdout/err of one submission.
+
+    Names carry the time to the second and the pid of the submitting
+    process, so submissions in the same minute, or of different cli
+    scripts sharing <parent>, never share a directory.
+
+    Parameters
+    ----------
+    parent : str
+        /path/to/scratch or derivatives dir, holding slurm_out
+    prefix : str
+        cli identifier, e.g. "afni"
+
+    Returns
+    -------
+    str
+        <parent>/slurm_out/<prefix>_<yy-mm-dd_HHMMSS>_<pid>
+    """
+    stamp = datetime.now().strftime("%y-%m-%d_%H%M%S")
+    slurm_dir = os.path.join(parent, "slurm_out", f"{prefix}_{stamp}_{os.getpid()}")
+    os.makedirs(slurm_dir)
+    return slurm_dir
+
+
+def write_params(slurm_dir, name, params):
+    """Write job parameters for a runner to <slurm_dir>/<name>.json.
+
+    Parameters are passed by file rather than in the submitted command,
+    as Linux limits a single argument, the --wrap command, to 128 KiB.
+    Each submission has its own slurm_dir (see make_slurm_dir), so a
+    queued job is not affected by later submissions.
+
+    Parameters
+    ----------
+    slurm_dir : str
+        path to location for capturing sbatch stdout/err
+    name : str
+        file name without extension, e.g. "subj_params"
+    params : list or dict
+        json-serializable job parameters
+
+    Returns
+    -------
+    str
+        /path/to/slurm_dir/<name>.json
+    """
+    params_file = os.path.join(slurm_dir, f"{name}.json")
+    with open(params_file, "w") as jf:
+        json.dump(params, jf)
+    return params_file
+
+
+def read_params(params_file):
+    """Read job parameters written by write_params.
+
+    Parameters
+    ----------
+    params_file : str
+        /path/to/slurm_dir/<name>.json
+
+    Returns
+    -------
+    list or dict
+        job parameters
+    """
+    with open(params_file) as jf:
+        return json.load(jf)
+
+
+def array_task(params_file):
+    """Get the parameters of this array task.
+
+    Parameters
+    ----------
+    params_file : str
+        /path/to/slurm_dir/subj_params.json, a json list with one
+        entry per array task, see write_params
+
+    Returns
+    -------
+    entry of params_file at SLURM_ARRAY_TASK_ID
+    """
+    return read_params(params_file)[int(os.environ["SLURM_ARRAY_TASK_ID"])]
+
+
+def submit(cmd, *, job_name, slurm_dir, time_limit, array_size=None):
+    """Submit a command to SLURM via sbatch --wrap.
+
+    Parameters
+    ----------
+    cmd : list
+        argv of command to run, e.g. [sys.executable, "/path/to/runner.py"]
+    job_name : str
+        sbatch job name
+    slurm_dir : str
+        path to location for capturing sbatch stdout/err
+    time_limit : str
+        sbatch time limit, e.g. "10:00:00"
+    array_size : int, optional
+        submit as a job array of tasks 0 .. array_size - 1
+
+    Returns
+    -------
+    h_out, h_err : bytes
+        stdout (b"1234", see job_id), stderr of sbatch submission
+    """
+    sbatch_args = [f"--job-name={job_name}", f"--time={time_limit}"]
+    sbatch_args += [f"--{key}={value}" for key, value in SBATCH_DEFAULTS.items()]
+    if array_size:
+        sbatch_args += [
+            f"--output={slurm_dir}/out_%A_%a.txt",
+            f"--array=0-{array_size - 1}",
+        ]
+    else:
+        sbatch_args.append(f"--output={slurm_dir}/out_%j.txt")
+    sbatch_args.append(f"--wrap={shlex.join(cmd)}")
+    return run_sbatch(sbatch_args)
@@ -28,12 +28,17 @@ sbatch --job-name=runRSGroup \
 # %%
 import os
 import sys
-from datetime import datetime
 import textwrap
-import glob
-import subprocess
+import re
 from argparse import ArgumentParser, RawTextHelpFormatter
-import pandas as pd
+from func_processing.cli._discover import index_subjects
+from func_processing.cli._logs import load_log
+from func_processing.cli._sbatch import (
+    make_slurm_dir,
+    report_submission,
+    submit,
+    write_params,
+)
 
 
 # %%
@@ -67,44 +72,25 @@ def submit_jobs(
     h_out, h_err : str
         stdout, stderr of sbatch submission
     """
-    h_cmd = f"""\
-        #!/bin/env {sys.executable}
-
-        #SBATCH --job-name=rsGroup
-        #SBATCH --output={slurm_dir}/out_rsGroup.txt
-        #SBATCH --time=10:00:00
-        #SBATCH --mem=4000
-        #SBATCH --partition=IB_44C_512G
-        #SBATCH --account=iacc_madlab
-        #SBATCH --qos=pq_madlab
-
-        import os
-        import sys
-        sys.path.append("{code_dir}")
-        from workflow import control_afni
-
-        group_data = {group_data}
-        group_data = control_afni.control_resting_group(
-            "{seed}",
-            "{task}",
-            "{afni_dir}",
-            "{group_dir}",
-            group_data,
-            {do_blur},
-        )
-        print(f"Job finished with group_data : \\n{{group_data}}")
-    """
-
-    # write script for review, run it
-    cmd_dedent = textwrap.dedent(h_cmd)
-    py_script = os.path.join(slurm_dir, f"RS_{seed}_group.py")
-    with open(py_script, "w") as h_script:
-        h_script.write(cmd_dedent)
-    sbatch_response = subprocess.Popen(
-        f"sbatch {py_script}", shell=True, stdout=subprocess.PIPE
+    group_file = write_params(slurm_dir, "group_data", group_data)
+
+    runner_cmd = [
+        sys.executable,
+        os.path.join(code_dir, "cli/_afni_group_runner.py"),
+        f"--seed={seed}",
+        f"--task={task}",
+        f"--afni-dir={afni_dir}",
+        f"--group-dir={group_dir}",
+        f"--group-json-file={group_file}",
+    ]
+    if do_blur:
+        runner_cmd.append("--blur")
+    return submit(
+        runner_cmd,
+        job_name="rsGroup",
+        slurm_dir=slurm_dir,
+        time_limit="10:00:00",
     )
-    h_out, h_err = sbatch_response.communicate()
-    return (h_out, h_err)
 
 
 # %%
@@ -197,11 +183,10 @@ def main():
     log_dir = os.path.join(code_dir, "logs")
     afni_dir = os.path.join(proj_dir, "derivatives/afni")
     group_dir = os.path.join(afni_dir, "analyses")
-    if not os.path.exists(group_dir):
-        os.makedirs(group_dir)
+    os.makedirs(group_dir, exist_ok=True)
 
     # get completed logs
-    df_log = pd.read_csv(os.path.join(log_dir, "completed_preprocessing.tsv"), sep="\t")
+    df_log = load_log(log_dir, columns=["subjID"])
     subj_list_all = df_log["subjID"].tolist()
 
     # start group_data with template gm mask
@@ -212,19 +197,28 @@ def main():
     assert os.path.exists(tpl_gm), f"Template GM not detected: {tpl_gm}"
     group_data["mask-gm"] = tpl_gm
 
-    # make list of subjs with required data
+    # make list of subjs with required data, from one walk of afni_dir
+    subj_index = index_subjects(afni_dir, depth=4)
+    mask_pat = re.compile(
+        rf"(sub-[^_]+)_.*_{re.escape(task)}_.*intersect_mask\.nii\.gz$"
+    )
+    ztrans_name = f"decon_{task}_anaticor_{seed}_ztrans+tlrc.HEAD"
     subj_list = []
     ztrans_list = []
     for subj in subj_list_all:
         print(f"Checking {subj} for required files ...")
-        mask_exists = glob.glob(
-            f"{afni_dir}/{subj}/**/anat/{subj}_*_{task}_*intersect_mask.nii.gz",
-            recursive=True,
-        )
-        ztrans_exists = glob.glob(
-            f"{afni_dir}/{subj}/**/func/decon_{task}_anaticor_{seed}_ztrans+tlrc.HEAD",
-            recursive=True,
-        )
+        mask_exists = False
+        ztrans_exists = []
+        for h_path in sorted(subj_index.get(subj, [])):
+            h_dir, h_name = os.path.split(h_path)
+            h_parent = os.path.basename(h_dir)
+            if h_parent == "anat":
+                mask_match = mask_pat.match(h_name)
+                mask_exists = mask_exists or bool(
+                    mask_match and mask_match.group(1) == subj
+                )
+            elif h_parent == "func" and h_name == ztrans_name:
+                ztrans_exists.append(h_path)
         if mask_exists and ztrans_exists:
             print(f"\tAdding {subj} to group_data\n")
             subj_list.append(subj)
@@ -234,25 +228,22 @@ def main():
     group_data["all-ztrans"] = ztrans_list
 
     # submit work
-    current_time = datetime.now()
-    slurm_dir = os.path.join(
-        afni_dir,
-        f"""slurm_out/afni_{current_time.strftime("%y-%m-%d_%H:%M")}""",
-    )
-    if not os.path.exists(slurm_dir):
-        os.makedirs(slurm_dir)
+    slurm_dir = make_slurm_dir(afni_dir, "afni")
 
     print(f"\ngroup_data : \n {group_data}")
-    _, _ = submit_jobs(
+    h_out, h_err = submit_jobs(
         seed, task, afni_dir, group_dir, group_data, slurm_dir, code_dir, do_blur
     )
+    report_submission(h_out, h_err)
 
 
 if __name__ == "__main__":
 
+    # parse first, --help does not require the environment
+    get_args().parse_args()
+
     # require environment
-    env_found = [x for x in sys.path if "emuR01" in x]
-    if not env_found:
+    if not any("emuR01" in x for x in sys.path):
         print("\nERROR: madlab conda env emuR01 required.")
         print("\tHint: $madlab_env emuR01\n")
         sys.exit()
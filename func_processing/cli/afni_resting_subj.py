@@ -37,14 +37,24 @@ sbatch --job-name=runAfniRest \
 # %%
 import os
 import sys
-import glob
-import time
 import json
-from datetime import datetime
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import textwrap
-import subprocess
 from argparse import ArgumentParser, RawTextHelpFormatter
-import pandas as pd
+from func_processing.cli._afni_common import (
+    find_output,
+    has_prep_output,
+    output_pattern,
+    prep_pattern,
+)
+from func_processing.cli._logs import load_log
+from func_processing.cli._sbatch import (
+    make_slurm_dir,
+    report_submission,
+    submit,
+    write_params,
+)
 
 
 # %%
@@ -54,20 +64,21 @@ def submit_jobs(
     code_dir,
     coord_dict,
     do_blur,
-    do_regress,
     kp_interm,
     proj_dir,
     sess,
     slurm_dir,
-    subj,
+    subj_dict,
     task,
     tplflow_str,
 ):
-    """Schedule work for single participant.
+    """Schedule work for a batch of participants.
 
-    Submit workflow.control_afni for a single subject, session,
-    and task. Take data from fMRIprep output through deconvolution.
-    Finally, clean up, and move relevant files to <afni_final>.
+    Submit cli/_afni_rest_runner.py for each subject as a task of a
+    single job array. Each array task selects its subject from
+    <slurm_dir>/subj_params.json via SLURM_ARRAY_TASK_ID, and then
+    takes data from fMRIprep output through deconvolution. Finally,
+    clean up, and move relevant files to <afni_final>.
 
     Parameters
     ----------
@@ -81,8 +92,6 @@ def submit_jobs(
         seed name and coordinates
     do_blur : bool
         [T/F] whether to blur as part of pre-processing
-    do_regress : bool
-        whether to conduct deconvolution/regression
     kp_interm : bool
         [T/F] whether to keep (T) or remove (F) intemediates
     proj_dir : str
@@ -91,8 +100,9 @@ def submit_jobs(
         BIDS session string
     slurm_dir : str
         path to location for capturing sbatch stdout/err
-    subj : str
-        BIDS subject string
+    subj_dict : dict
+        {sub-1234: {"Regress": bool}}, whether to conduct
+        deconvolution/regression for each subject
     task : str
         BIDS task string
     tplflow_str : str
@@ -103,109 +113,43 @@ def submit_jobs(
     h_out, h_err : str
         stdout, stderr of sbatch submission
     """
-    subj_num = subj.split("-")[-1]
     prep_dir = os.path.join(proj_dir, "derivatives/fmriprep")
 
-    h_cmd = f"""\
-        #!/bin/env {sys.executable}
-
-        #SBATCH --job-name=p{subj_num}
-        #SBATCH --output={slurm_dir}/out_{subj_num}.txt
-        #SBATCH --time=10:00:00
-        #SBATCH --mem=4000
-        #SBATCH --partition=IB_44C_512G
-        #SBATCH --account=iacc_madlab
-        #SBATCH --qos=pq_madlab
-
-        import os
-        import sys
-        import shutil
-        import glob
-        import subprocess
-        sys.path.append("{code_dir}")
-        from workflow import control_afni
-
-        afni_data = control_afni.control_preproc(
-            "{prep_dir}",
-            "{afni_dir}",
-            "{subj}",
-            "{sess}",
-            "{task}",
-            "{tplflow_str}",
-            {do_blur},
-        )
-        print(f"afni_data : \\n {{afni_data}}")
-
-        if {do_regress}:
-            afni_data = control_afni.control_resting(
-                afni_data,
-                "{afni_dir}",
-                "{subj}",
-                "{sess}",
-                {coord_dict},
-                {kp_interm},
-            )
-        print(f"Finished {subj}/{sess}/{task} with: \\n {{afni_data}}")
-
-        # clean up
-        if not {kp_interm}:
-            shutil.rmtree(os.path.join("{afni_dir}", "{subj}", "{sess}", "sbatch_out"))
-            clean_dir = os.path.join("{afni_dir}", "{subj}", "{sess}")
-            clean_list = [
-                "preproc_bold",
-                "smoothed_bold",
-                "nuissance_bold",
-                "probseg",
-                "preproc_T1w",
-                "minval_mask",
-                "GMe_mask",
-                "meanTS_bold",
-                "sdTS_bold",
-                "blurWM_bold",
-                "combWM_bold",
-                "masked_bold",
-            ]
-            for c_str in clean_list:
-                for h_file in glob.glob(f"{{clean_dir}}/**/*{{c_str}}.nii.gz", recursive=True):
-                    os.remove(h_file)
-
-            # clean up other, based on extension
-            clean_list = [
-                "unit+tlrc.HEAD",
-                "unit+tlrc.BRIK",
-                "corr+tlrc.HEAD",
-                "corr+tlrc.BRIK",
-                "1D00.1D",
-                "1D01.1D",
-                "1D02.1D",
-                "1D_eig.1D",
-                "1D_vec.1D",
-                "csfPC_timeseries.1D",
-                "tmp-censor_timeseries.1D",
-            ]
-            for c_str in clean_list:
-                for h_file in glob.glob(f"{{clean_dir}}/**/*{{c_str}}", recursive=True):
-                    os.remove(h_file)
-
-        # copy important files to /home/data
-        h_cmd = f"cp -r {afni_dir}/{subj} {afni_final}"
-        h_cp = subprocess.Popen(h_cmd, shell=True, stdout=subprocess.PIPE)
-        h_job = h_cp.communicate()
-
-        # turn out the lights
-        shutil.rmtree(os.path.join("{afni_dir}", "{subj}"))
-    """
-
-    # write script for review, run it
-    cmd_dedent = textwrap.dedent(h_cmd)
-    py_script = os.path.join(slurm_dir, f"preproc_regress_{subj_num}.py")
-    with open(py_script, "w") as h_script:
-        h_script.write(cmd_dedent)
-    sbatch_response = subprocess.Popen(
-        f"sbatch {py_script}", shell=True, stdout=subprocess.PIPE
+    # array index -> subject mapping, read by each task from slurm_dir
+    subj_params = [
+        {"subj": subj, "do_regress": value_dict["Regress"]}
+        for subj, value_dict in subj_dict.items()
+    ]
+
+    subj_file = write_params(slurm_dir, "subj_params", subj_params)
+
+    # each array task runs cli/_afni_rest_runner.py for one subject
+    runner_cmd = [
+        sys.executable,
+        os.path.join(code_dir, "cli/_afni_rest_runner.py"),
+        f"--subj-params-file={subj_file}",
+        f"--log-dir={slurm_dir}",
+        f"--prep-dir={prep_dir}",
+        f"--afni-dir={afni_dir}",
+        f"--afni-final={afni_final}",
+        f"--sess={sess}",
+        f"--task={task}",
+        f"--tplflow-str={tplflow_str}",
+        f"--coord-dict={json.dumps(coord_dict)}",
+    ]
+    if do_blur:
+        runner_cmd.append("--blur")
+    if kp_interm:
+        runner_cmd.append("--keep-interm")
+
+    # run as an array of len(subj_dict)
+    return submit(
+        runner_cmd,
+        job_name="pRest",
+        slurm_dir=slurm_dir,
+        time_limit="10:00:00",
+        array_size=len(subj_params),
     )
-    h_out, h_err = sbatch_response.communicate()
-    return (h_out, h_err)
 
 
 # %%
@@ -245,6 +189,16 @@ def get_args():
             """
         ),
     )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Toggle of whether to only print the subjects found, without
+            scheduling work. Boolean (True if "--dry-run", else False).
+            """
+        ),
+    )
     parser.add_argument(
         "--keep-interm",
         action="store_true",
@@ -340,6 +294,104 @@ def get_args():
     return parser
 
 
+# %%
+def iter_ready_subjects(
+    afni_final, log_dir, out_dir, prep_dir, sess, task, tplflow_str
+):
+    """Yield subjects with fmriprep output who are missing afni output.
+
+    Subjects are checked in windows as the generator is consumed,
+    so callers may stop early without checking the remaining subjects.
+
+    Parameters
+    ----------
+    afni_final : str
+        /path/to/project_dir/derivatives/afni, or out_dir
+    log_dir : str
+        /path/to/code_dir/logs, location of completed_preprocessing.tsv
+    out_dir : str, None
+        user specified output location
+    prep_dir : str
+        /path/to/project_dir/derivatives/fmriprep
+    sess : str
+        BIDS session string (ses-S1)
+    task : str
+        BIDS task string (task-rest)
+    tplflow_str : str
+        template_flow identifier string
+
+    Yields
+    ------
+    (subj, regress_missing) : tuple
+        subject ID, whether deconvolution is missing
+    """
+    # get completed logs
+    log_cols = [
+        "wme_mask",
+        f"intersect_{sess}_{task}",
+        "decon_resting",
+        "scaled_resting",
+    ]
+    df_log = load_log(log_dir, columns=["subjID"] + log_cols)
+    df_log = df_log.set_index("subjID")
+    df_missing = df_log[log_cols].isnull()
+
+    # map subject to row position, for positional lookups in check_subject
+    row_for = {subj: ind for ind, subj in enumerate(df_missing.index)}
+    regress_col = df_missing.columns.get_loc("decon_resting")
+    any_missing_all = df_missing.any(axis=1)
+
+    # make list of subjects who have fmriprep output and are
+    # missing afni deconvolutions
+    prep_pat = prep_pattern(task, tplflow_str)
+    out_pat = output_pattern(sess, task)
+
+    def check_subject(subj):
+        """Return (subj, regress_missing) if subj needs work, else None."""
+        # check for required fmriprep output
+        print(f"Checking {subj} for previous work ...")
+        if not has_prep_output(prep_pat, prep_dir, subj, sess):
+            return None
+
+        # Check for missing certain pre-processing files, account for
+        # user specified output location
+        if out_dir:
+            out_found = find_output(out_pat, afni_final, subj, sess)
+            regress_missing = not os.path.exists(
+                os.path.join(afni_final, subj, sess, "func", f"X.decon_{task}.xmat.1D")
+            )
+            any_missing = (
+                "wme" not in out_found
+                or "intx" not in out_found
+                or "scaled" not in out_found
+                or regress_missing
+            )
+        else:
+            ind_subj = row_for[subj]
+            regress_missing = bool(df_missing.iat[ind_subj, regress_col])
+            any_missing = bool(any_missing_all.iat[ind_subj])
+
+        # Append subj_list if fmriprep data exists and afni data is missing.
+        if any_missing:
+            print(f"\tAdding {subj} to working list (subj_dict).\n")
+            return (subj, regress_missing)
+        return None
+
+    # checks are filesystem bound, overlap them across a window of
+    # subjects and only check the next window on demand
+    # without user-specified output the logs alone determine missing
+    # output, so only check subjects with an incomplete log
+    if out_dir:
+        subj_list_all = df_log.index.tolist()
+    else:
+        subj_list_all = df_log.index[any_missing_all].tolist()
+    num_workers = 32
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for ind in range(0, len(subj_list_all), num_workers):
+            h_list = subj_list_all[ind : ind + num_workers]
+            yield from filter(None, executor.map(check_subject, h_list))
+
+
 # %%
 def main():
     """Set up for workflow.
@@ -354,6 +406,7 @@ def main():
     do_blur = args.blur
     code_dir = args.code_dir
     coord_json = args.coord_json
+    dry_run = args.dry_run
     kp_interm = args.keep_interm
     out_dir = args.out_dir
     proj_dir = args.proj_dir
@@ -365,105 +418,55 @@ def main():
     log_dir = os.path.join(code_dir, "logs")
     prep_dir = os.path.join(proj_dir, "derivatives/fmriprep")
     afni_final = out_dir if out_dir else os.path.join(proj_dir, "derivatives/afni")
-    if not os.path.exists(afni_final):
-        os.makedirs(afni_final)
+    os.makedirs(afni_final, exist_ok=True)
     with open(coord_json) as json_file:
         coord_dict = json.load(json_file)
 
-    # get completed logs
-    df_log = pd.read_csv(os.path.join(log_dir, "completed_preprocessing.tsv"), sep="\t")
-
-    # make list of subjects who have fmriprep output and are
-    # missing afni deconvolutions
-    subj_list_all = df_log["subjID"].tolist()
-    subj_dict = {}
-    for subj in subj_list_all:
-
-        # check for required fmriprep output
-        print(f"Checking {subj} for previous work ...")
-        anat_check = glob.glob(
-            f"{prep_dir}/{subj}/**/*_{tplflow_str}_desc-preproc_T1w.nii.gz",
-            recursive=True,
-        )
-        func_check = glob.glob(
-            f"{prep_dir}/{subj}/**/*{task}*{tplflow_str}_desc-preproc_bold.nii.gz",
-            recursive=True,
-        )
-        if not anat_check or not func_check:
-            continue
-
-        # Check for missing certain pre-processing files, account for
-        # user specified output location
-        if out_dir:
-            subj_dir = os.path.join(afni_final, subj, sess)
-            wme_found = glob.glob(f"{subj_dir}/anat/*desc-WMe_mask.nii.gz")
-            intx_found = glob.glob(
-                f"{subj_dir}/anat/*{sess}_{task}*desc-intersect_mask.nii.gz"
-            )
-            scaled_found = glob.glob(
-                f"{subj_dir}/func/*{sess}_{task}_run-1*desc-scaled_bold.nii.gz"
-            )
-            regress_found = glob.glob(f"{subj_dir}/func/X.decon_{task}.xmat.1D")
-
-            # invert bool to match with existing structure
-            wme_missing = False if wme_found else True
-            intersect_missing = False if intx_found else True
-            scaled_missing = False if scaled_found else True
-            regress_missing = False if regress_found else True
-        else:
-            ind_subj = df_log.index[df_log["subjID"] == subj]
-            wme_missing = pd.isnull(df_log.loc[ind_subj, "wme_mask"]).bool()
-            intersect_missing = pd.isnull(
-                df_log.loc[ind_subj, f"intersect_{sess}_{task}"]
-            ).bool()
-            regress_missing = pd.isnull(df_log.loc[ind_subj, "decon_resting"]).bool()
-            scaled_missing = pd.isnull(df_log.loc[ind_subj, "scaled_resting"]).bool()
-
-        # Append subj_list if fmriprep data exists and afni data is missing.
-        if intersect_missing or wme_missing or regress_missing or scaled_missing:
-            print(f"\tAdding {subj} to working list (subj_dict).\n")
-            subj_dict[subj] = {"Regress": regress_missing}
+    # find a batch of subjects, stopping once it is found
+    subj_iter = iter_ready_subjects(
+        afni_final, log_dir, out_dir, prep_dir, sess, task, tplflow_str
+    )
+    subj_dict = {
+        subj: {"Regress": regress_missing}
+        for subj, regress_missing in itertools.islice(subj_iter, batch_num)
+    }
 
     # kill for no subjects
     if len(subj_dict.keys()) == 0:
         return
+    if dry_run:
+        print(f"Subjects found for {sess} {task}:\n\t{' '.join(subj_dict)}\n")
+        return
 
     # submit workflow.control_afni for each subject
-    current_time = datetime.now()
-    slurm_dir = os.path.join(
+    slurm_dir = make_slurm_dir(afni_dir, "afni")
+
+    # submit batch as a single job array
+    print(f"Submitting jobs for {sess} {task}:\n\t{' '.join(subj_dict)}\n")
+    h_out, h_err = submit_jobs(
         afni_dir,
-        f"""slurm_out/afni_{current_time.strftime("%y-%m-%d_%H:%M")}""",
+        afni_final,
+        code_dir,
+        coord_dict,
+        do_blur,
+        kp_interm,
+        proj_dir,
+        sess,
+        slurm_dir,
+        subj_dict,
+        task,
+        tplflow_str,
     )
-    if not os.path.exists(slurm_dir):
-        os.makedirs(slurm_dir)
-
-    for subj, value_dict in list(subj_dict.items())[:batch_num]:
-        print(f"Submitting job for {subj} {sess} {task}")
-        do_regress = value_dict["Regress"]
-        h_out, h_err = submit_jobs(
-            afni_dir,
-            afni_final,
-            code_dir,
-            coord_dict,
-            do_blur,
-            do_regress,
-            kp_interm,
-            proj_dir,
-            sess,
-            slurm_dir,
-            subj,
-            task,
-            tplflow_str,
-        )
-        time.sleep(3)
-        print(f"submit_jobs out: {h_out} \nsubmit_jobs err: {h_err}")
+    report_submission(h_out, h_err)
 
 
 if __name__ == "__main__":
 
+    # parse first, --help does not require the environment
+    get_args().parse_args()
+
     # require environment
-    env_found = [x for x in sys.path if "emuR01" in x]
-    if not env_found:
+    if not any("emuR01" in x for x in sys.path):
         print("\nERROR: madlab conda env emuR01 required.")
         print("\tHint: $madlab_env emuR01\n")
         sys.exit()
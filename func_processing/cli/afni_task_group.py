@@ -29,12 +29,18 @@ sbatch --job-name=runTaskGroup \
 # %%
 import os
 import sys
-from datetime import datetime
+import re
+from concurrent.futures import ThreadPoolExecutor
 import textwrap
-import glob
-import subprocess
 from argparse import ArgumentParser, RawTextHelpFormatter
-import pandas as pd
+from func_processing.cli._discover import list_files
+from func_processing.cli._logs import load_log
+from func_processing.cli._sbatch import (
+    make_slurm_dir,
+    report_submission,
+    submit,
+    write_params,
+)
 
 
 # %%
@@ -70,46 +76,27 @@ def submit_jobs(
     h_out, h_err : str
         stdout, stderr of sbatch submission
     """
-    h_cmd = f"""\
-        #!/bin/env {sys.executable}
+    group_file = write_params(slurm_dir, "group_data", group_data)
 
-        #SBATCH --job-name=taskGroup
-        #SBATCH --output={slurm_dir}/out_taskGroup.txt
-        #SBATCH --time=10:00:00
-        #SBATCH --mem=4000
-        #SBATCH --partition=IB_44C_512G
-        #SBATCH --account=iacc_madlab
-        #SBATCH --qos=pq_madlab
-
-        import os
-        import sys
-        sys.path.append("{code_dir}")
-        from workflow import control_afni
-
-        group_data = {group_data}
-        beh_list = {beh_list}
-        group_data = control_afni.control_task_group(
-            beh_list,
-            "{task}",
-            "{sess}",
-            "{afni_dir}",
-            "{group_dir}",
-            group_data,
-            {do_blur},
-        )
-        print(f"Job finished with group_data : \\n{{group_data}}")
-    """
-
-    # write script for review, run it
-    cmd_dedent = textwrap.dedent(h_cmd)
-    py_script = os.path.join(slurm_dir, "Task_behAB_group.py")
-    with open(py_script, "w") as h_script:
-        h_script.write(cmd_dedent)
-    sbatch_response = subprocess.Popen(
-        f"sbatch {py_script}", shell=True, stdout=subprocess.PIPE
+    runner_cmd = [
+        sys.executable,
+        os.path.join(code_dir, "cli/_afni_group_runner.py"),
+        "--beh-list",
+        *beh_list,
+        f"--task={task}",
+        f"--sess={sess}",
+        f"--afni-dir={afni_dir}",
+        f"--group-dir={group_dir}",
+        f"--group-json-file={group_file}",
+    ]
+    if do_blur:
+        runner_cmd.append("--blur")
+    return submit(
+        runner_cmd,
+        job_name="taskGroup",
+        slurm_dir=slurm_dir,
+        time_limit="10:00:00",
     )
-    h_out, h_err = sbatch_response.communicate()
-    return (h_out, h_err)
 
 
 # %%
@@ -149,6 +136,16 @@ def get_args():
             """
         ),
     )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            Toggle of whether to only print the subjects found, without
+            scheduling work. Boolean (True if "--dry-run", else False).
+            """
+        ),
+    )
 
     required_args = parser.add_argument_group("Required Arguments")
     required_args.add_argument(
@@ -212,16 +209,16 @@ def main():
     decon_str = args.dcn_str
     beh_list = args.behaviors
     do_blur = args.blur
+    dry_run = args.dry_run
 
     # set up
     log_dir = os.path.join(code_dir, "logs")
     afni_dir = os.path.join(proj_dir, "derivatives/afni")
     group_dir = os.path.join(afni_dir, "analyses")
-    if not os.path.exists(group_dir):
-        os.makedirs(group_dir)
+    os.makedirs(group_dir, exist_ok=True)
 
     # get completed logs
-    df_log = pd.read_csv(os.path.join(log_dir, "completed_preprocessing.tsv"), sep="\t")
+    df_log = load_log(log_dir, columns=["subjID"])
     subj_list_all = df_log["subjID"].tolist()
 
     # start group_data with template gm mask, decon string
@@ -234,33 +231,39 @@ def main():
     group_data["dcn-file"] = decon_str
 
     # make list of subjs with required data
-    subj_list = []
-    for subj in subj_list_all:
+    mask_pat = re.compile(
+        rf"(sub-[^_]+)_.*_{re.escape(task)}_.*intersect_mask\.nii\.gz$"
+    )
+    decon_file = f"{decon_str}.HEAD"
+
+    def check_subject(subj):
+        """Return subj if required files exist, else None."""
         print(f"Checking {subj} for required files ...")
-        mask_exists = glob.glob(
-            f"{afni_dir}/{subj}/**/anat/{subj}_*_{task}_*intersect_mask.nii.gz",
-            recursive=True,
-        )
-        decon_exists = glob.glob(
-            f"{afni_dir}/{subj}/{sess}/func/{decon_str}.HEAD",
+        anat_files = list_files(os.path.join(afni_dir, subj, sess, "anat"))
+        func_files = list_files(os.path.join(afni_dir, subj, sess, "func"))
+        mask_exists = any(
+            x.group(1) == subj for x in map(mask_pat.match, anat_files) if x
         )
+        decon_exists = decon_file in func_files
         if mask_exists and decon_exists:
             print(f"\tAdding {subj} to group_data\n")
-            subj_list.append(subj)
+            return subj
+        return None
+
+    # checks are filesystem bound, overlap them across subjects
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        subj_list = [x for x in executor.map(check_subject, subj_list_all) if x]
     assert len(subj_list) > 1, "Insufficient subject data found."
     group_data["subj-list"] = subj_list
+    if dry_run:
+        print(f"\ngroup_data : \n {group_data}")
+        return
 
     # submit work
-    current_time = datetime.now()
-    slurm_dir = os.path.join(
-        afni_dir,
-        f"""slurm_out/afni_{current_time.strftime("%y-%m-%d_%H:%M")}""",
-    )
-    if not os.path.exists(slurm_dir):
-        os.makedirs(slurm_dir)
+    slurm_dir = make_slurm_dir(afni_dir, "afni")
 
     print(f"\ngroup_data : \n {group_data}")
-    _, _ = submit_jobs(
+    h_out, h_err = submit_jobs(
         beh_list,
         task,
         sess,
@@ -271,13 +274,16 @@ def main():
         code_dir,
         do_blur,
     )
+    report_submission(h_out, h_err)
 
 
 if __name__ == "__main__":
 
+    # parse first, --help does not require the environment
+    get_args().parse_args()
+
     # require environment
-    env_found = [x for x in sys.path if "emuR01" in x]
-    if not env_found:
+    if not any("emuR01" in x for x in sys.path):
         print("\nERROR: madlab conda env emuR01 required.")
         print("\tHint: $madlab_env emuR01\n")
         sys.exit()
@@ -38,37 +38,69 @@ sbatch --job-name=runAfniTask \
 import os
 import sys
 import json
-import glob
-import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import textwrap
-import subprocess
 from argparse import ArgumentParser, RawTextHelpFormatter
-import pandas as pd
+from func_processing.cli._afni_common import (
+    find_output,
+    has_prep_output,
+    output_pattern,
+    prep_pattern,
+)
+from func_processing.cli._discover import list_files
+from func_processing.cli._logs import load_log
+from func_processing.cli._sbatch import (
+    make_slurm_dir,
+    report_submission,
+    submit,
+    write_params,
+)
 
 
 # %%
+def index_decon_plans(json_files):
+    """Key decon plan JSONs by subject.
+
+    Parameters
+    ----------
+    json_files : list
+        file names of --json-dir, e.g. ["sub-1234_decon.json", ...]
+
+    Returns
+    -------
+    dict
+        {sub-1234: sub-1234_decon.json}, the first JSON in sorted
+        order of each subject
+    """
+    json_index = {}
+    for json_file in sorted(json_files):
+        if json_file.startswith("sub-") and json_file.endswith(".json"):
+            subj = json_file.split("_")[0].split(".")[0]
+            json_index.setdefault(subj, json_file)
+    return json_index
+
+
 def submit_jobs(
     afni_dir,
     afni_final,
     code_dir,
-    decon_plan,
     do_blur,
-    do_decon,
     dur,
     kp_interm,
     proj_dir,
     sess,
     slurm_dir,
-    subj,
+    subj_dict,
     task,
     tplflow_str,
 ):
-    """Schedule work for single participant.
+    """Schedule work for a batch of participants.
 
-    Submit workflow.control_afni for a single subject, session,
-    and task. Take data from fMRIprep output through deconvolution.
-    Finally, clean up, and move relevant files to <afni_final>.
+    Submit cli/_afni_runner.py for each subject as a task of a
+    single job array. Each array task selects its subject from
+    <slurm_dir>/subj_params.json via SLURM_ARRAY_TASK_ID, and then
+    takes data from fMRIprep output through deconvolution. Finally,
+    clean up, and move relevant files to <afni_final>.
 
     Parameters
     ----------
@@ -78,12 +110,8 @@ def submit_jobs(
         path to desired output location of final files
     code_dir : str
         path to clone of github.com/emu-project/func_processing.git
-    decon_plan : dict/None
-        planned deconvolution with behavior: timing file mappings
     do_blur : bool
         [T/F] whether to blur as part of pre-processing
-    do_decon : bool
-        whether to conduct deconvolution
     dur : int/float/str
         duration of event to be modeled
     kp_interm : bool
@@ -94,8 +122,10 @@ def submit_jobs(
         BIDS session string
     slurm_dir : str
         path to location for capturing sbatch stdout/err
-    subj : str
-        BIDS subject string
+    subj_dict : dict
+        {sub-1234: {"Decon": bool, "Decon_plan": dict/None}}, whether
+        to conduct deconvolution, and planned deconvolution with
+        behavior: timing file mappings, for each subject
     task : str
         BIDS task string
     tplflow_str : str
@@ -106,89 +136,49 @@ def submit_jobs(
     h_out, h_err : str
         stdout, stderr of sbatch submission
     """
-    subj_num = subj.split("-")[-1]
     prep_dir = os.path.join(proj_dir, "derivatives/fmriprep")
     dset_dir = os.path.join(proj_dir, "dset")
 
-    h_cmd = f"""\
-        #!/bin/env {sys.executable}
-
-        #SBATCH --job-name=p{subj_num}
-        #SBATCH --output={slurm_dir}/out_{subj_num}.txt
-        #SBATCH --time=10:00:00
-        #SBATCH --mem=4000
-        #SBATCH --partition=IB_44C_512G
-        #SBATCH --account=iacc_madlab
-        #SBATCH --qos=pq_madlab
-
-        import os
-        import sys
-        import shutil
-        import glob
-        import subprocess
-        sys.path.append("{code_dir}")
-        from workflow import control_afni
-
-        afni_data = control_afni.control_preproc(
-            "{prep_dir}",
-            "{afni_dir}",
-            "{subj}",
-            "{sess}",
-            "{task}",
-            "{tplflow_str}",
-            {do_blur},
-        )
-
-        if {do_decon}:
-            afni_data = control_afni.control_deconvolution(
-                afni_data,
-                "{afni_dir}",
-                "{dset_dir}",
-                "{subj}",
-                "{sess}",
-                "{task}",
-                "{dur}",
-                {decon_plan},
-                {kp_interm},
-            )
-            print(f"Finished {subj}/{sess}/{task} with: \\n {{afni_data}}")
-
-        # clean up
-        if not {kp_interm}:
-            shutil.rmtree(os.path.join("{afni_dir}", "{subj}", "{sess}", "sbatch_out"))
-            clean_dir = os.path.join("{afni_dir}", "{subj}", "{sess}")
-            clean_list = [
-                "preproc_bold",
-                "smoothed_bold",
-                "nuissance_bold",
-                "probseg",
-                "preproc_T1w",
-                "minval_mask",
-                "GMe_mask",
-            ]
-            for c_str in clean_list:
-                for h_file in glob.glob(f"{{clean_dir}}/**/*{{c_str}}.nii.gz", recursive=True):
-                    os.remove(h_file)
-
-        # copy important files to /home/data
-        h_cmd = f"cp -r {afni_dir}/{subj} {afni_final}"
-        h_cp = subprocess.Popen(h_cmd, shell=True, stdout=subprocess.PIPE)
-        h_job = h_cp.communicate()
-
-        # turn out the lights
-        shutil.rmtree(os.path.join("{afni_dir}", "{subj}"))
-    """
-
-    # write script for review, run it
-    cmd_dedent = textwrap.dedent(h_cmd)
-    py_script = os.path.join(slurm_dir, f"preproc_decon_{subj_num}.py")
-    with open(py_script, "w") as h_script:
-        h_script.write(cmd_dedent)
-    sbatch_response = subprocess.Popen(
-        f"sbatch {py_script}", shell=True, stdout=subprocess.PIPE
+    # array index -> subject mapping, read by each task from slurm_dir
+    subj_params = [
+        {
+            "subj": subj,
+            "do_decon": value_dict["Decon"],
+            "decon_plan": value_dict["Decon_plan"],
+        }
+        for subj, value_dict in subj_dict.items()
+    ]
+
+    subj_file = write_params(slurm_dir, "subj_params", subj_params)
+
+    # each array task runs cli/_afni_runner.py for one subject
+    runner_cmd = [
+        sys.executable,
+        os.path.join(code_dir, "cli/_afni_runner.py"),
+        f"--subj-params-file={subj_file}",
+        f"--log-dir={slurm_dir}",
+        f"--prep-dir={prep_dir}",
+        f"--afni-dir={afni_dir}",
+        f"--afni-final={afni_final}",
+        f"--dset-dir={dset_dir}",
+        f"--sess={sess}",
+        f"--task={task}",
+        f"--tplflow-str={tplflow_str}",
+        f"--dur={dur}",
+    ]
+    if do_blur:
+        runner_cmd.append("--blur")
+    if kp_interm:
+        runner_cmd.append("--keep-interm")
+
+    # run as an array of len(subj_dict)
+    return submit(
+        runner_cmd,
+        job_name="pTask",
+        slurm_dir=slurm_dir,
+        time_limit="10:00:00",
+        array_size=len(subj_params),
     )
-    h_out, h_err = sbatch_response.communicate()
-    return (h_out, h_err)
 
 
 # %%
@@ -368,129 +358,130 @@ def main():
     log_dir = os.path.join(code_dir, "logs")
     prep_dir = os.path.join(proj_dir, "derivatives/fmriprep")
     afni_final = out_dir if out_dir else os.path.join(proj_dir, "derivatives/afni")
-    if not os.path.exists(afni_final):
-        os.makedirs(afni_final)
-
-    # get completed logs
-    df_log = pd.read_csv(os.path.join(log_dir, "completed_preprocessing.tsv"), sep="\t")
+    os.makedirs(afni_final, exist_ok=True)
+
+    # get completed logs, determine missing output for all subjects at once
+    log_cols = [
+        "wme_mask",
+        f"intersect_{sess}_{task}",
+        f"scaled_{sess}_1",
+        f"decon_{sess}_1",
+    ]
+    df_log = load_log(log_dir, columns=["subjID"] + log_cols)
+    df_log = df_log.set_index("subjID", drop=False)
+    df_missing = df_log[log_cols].isnull()
 
     # make list of subjects who have fmriprep output and are
     # missing afni deconvolutions
-    subj_list_all = df_log["subjID"].tolist()
-    subj_dict = {}
-    for subj in subj_list_all:
+    prep_pat = prep_pattern(task, tplflow_str)
+    out_pat = output_pattern(sess, task)
 
+    # index decon plans once, looked up per subject by exact label
+    json_index = index_decon_plans(list_files(json_dir)) if json_dir else {}
+
+    def check_subject(subj):
+        """Return (subj, {"Decon": bool, "Decon_plan": dict}) if subj needs work."""
         # check for required fmriprep output
         print(f"Checking {subj} for previous work ...")
-        anat_check = glob.glob(
-            f"{prep_dir}/{subj}/**/*_{tplflow_str}_desc-preproc_T1w.nii.gz",
-            recursive=True,
-        )
-        func_check = glob.glob(
-            f"{prep_dir}/{subj}/**/*{task}*{tplflow_str}_desc-preproc_bold.nii.gz",
-            recursive=True,
-        )
-        if not anat_check or not func_check:
-            continue
+        if not has_prep_output(prep_pat, prep_dir, subj, sess):
+            return None
 
         # determine decon plans, None is default
         decon_plan = None
         if json_dir:
-            decon_glob = glob.glob(os.path.join(json_dir, f"{subj}*.json"))
-            if not decon_glob:
-                # assert decon_glob, f"No JSON found for {subj} in {json_dir}."
+            decon_json = json_index.get(subj)
+            if not decon_json:
+                # assert decon_json, f"No JSON found for {subj} in {json_dir}."
                 print(f"\tNo JSON found for {subj}, skipping ...")
-                continue
-            with open(decon_glob[0]) as h_jf:
+                return None
+            with open(os.path.join(json_dir, decon_json)) as h_jf:
                 decon_plan = json.load(h_jf)
 
         # Check for missing certain pre-processing files, account for
         # user specified output location
         if out_dir:
-            subj_dir = os.path.join(afni_final, subj, sess)
-            wme_found = glob.glob(f"{subj_dir}/anat/*desc-WMe_mask.nii.gz")
-            intx_found = glob.glob(
-                f"{subj_dir}/anat/*{sess}_{task}*desc-intersect_mask.nii.gz"
-            )
-            scaled_found = glob.glob(
-                f"{subj_dir}/func/*{sess}_{task}_run-1*desc-scaled_bold.nii.gz"
-            )
+            out_found = find_output(out_pat, afni_final, subj, sess)
 
             # invert bool to match with existing structure
-            wme_missing = False if wme_found else True
-            intersect_missing = False if intx_found else True
-            scaled_missing = False if scaled_found else True
+            wme_missing = "wme" not in out_found
+            intersect_missing = "intx" not in out_found
+            scaled_missing = "scaled" not in out_found
         else:
-            ind_subj = df_log.index[df_log["subjID"] == subj]
-            wme_missing = pd.isnull(df_log.loc[ind_subj, "wme_mask"]).bool()
-            intersect_missing = pd.isnull(
-                df_log.loc[ind_subj, f"intersect_{sess}_{task}"]
-            ).bool()
-            scaled_missing = pd.isnull(df_log.loc[ind_subj, f"scaled_{sess}_1"]).bool()
-
-        # determine if deconvolution is needed, account for user-specified jsons
+            wme_missing = bool(df_missing.at[subj, "wme_mask"])
+            intersect_missing = bool(df_missing.at[subj, f"intersect_{sess}_{task}"])
+            scaled_missing = bool(df_missing.at[subj, f"scaled_{sess}_1"])
+
+        # determine if deconvolution is needed, account for user-specified
+        # jsons, list func once rather than stat each plan
         if json_dir:
-            decon_beh = list(decon_plan.keys())[0]
-            subj_final = os.path.join(afni_final, subj, sess, "func")
-            decon_exists = glob.glob(
-                f"{subj_final}/decon_{task}_{decon_beh}_stats_REML+tlrc.HEAD"
+            func_files = set(list_files(os.path.join(afni_final, subj, sess, "func")))
+            decon_missing = not all(
+                f"decon_{task}_{decon_beh}_stats_REML+tlrc.HEAD" in func_files
+                for decon_beh in decon_plan
             )
-            decon_missing = False if decon_exists else True
         else:
-            decon_missing = pd.isnull(df_log.loc[ind_subj, f"decon_{sess}_1"]).bool()
+            decon_missing = bool(df_missing.at[subj, f"decon_{sess}_1"])
 
         # Append subj_list if afni data is missing.
         # Note - only add decon to dict, pre-processing is required to create
         # the afni_data object required by control_afni.control_deconvolution.
         if intersect_missing or wme_missing or decon_missing or scaled_missing:
             print(f"\tAdding {subj} to working list (subj_dict).\n")
-            subj_dict[subj] = {
-                "Decon": decon_missing,
-                "Decon_plan": decon_plan,
-            }
+            return (subj, {"Decon": decon_missing, "Decon_plan": decon_plan})
+        return None
+
+    # without user-specified output or jsons, the logs alone determine
+    # missing output, so only check subjects with an incomplete log
+    if out_dir or json_dir:
+        subj_list_all = df_log["subjID"].tolist()
+    else:
+        subj_list_all = df_log.index[df_missing.any(axis=1)].tolist()
+
+    # checks are filesystem bound, overlap them across a window of
+    # subjects, and stop once a batch has been found
+    subj_dict = {}
+    num_workers = 32
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for ind in range(0, len(subj_list_all), num_workers):
+            h_list = subj_list_all[ind : ind + num_workers]
+            subj_dict.update(x for x in executor.map(check_subject, h_list) if x)
+            if len(subj_dict) >= batch_num:
+                break
 
     # kill for no subjects
     if len(subj_dict.keys()) == 0:
         return
 
     # submit workflow.control_afni for each subject
-    current_time = datetime.now()
-    slurm_dir = os.path.join(
+    slurm_dir = make_slurm_dir(afni_dir, "afni")
+
+    # submit batch as a single job array
+    subj_batch = dict(list(subj_dict.items())[:batch_num])
+    print(f"Submitting jobs for {sess} {task}:\n\t{' '.join(subj_batch)}\n")
+    h_out, h_err = submit_jobs(
         afni_dir,
-        f"""slurm_out/afni_{current_time.strftime("%y-%m-%d_%H:%M")}""",
+        afni_final,
+        code_dir,
+        do_blur,
+        dur,
+        kp_interm,
+        proj_dir,
+        sess,
+        slurm_dir,
+        subj_batch,
+        task,
+        tplflow_str,
     )
-    if not os.path.exists(slurm_dir):
-        os.makedirs(slurm_dir)
-
-    for subj, value_dict in list(subj_dict.items())[:batch_num]:
-        print(f"Submitting job for {subj} {sess} {task}")
-        h_decon_plan = value_dict["Decon_plan"]
-        do_decon = value_dict["Decon"]
-        h_out, h_err = submit_jobs(
-            afni_dir,
-            afni_final,
-            code_dir,
-            h_decon_plan,
-            do_blur,
-            do_decon,
-            dur,
-            kp_interm,
-            proj_dir,
-            sess,
-            slurm_dir,
-            subj,
-            task,
-            tplflow_str,
-        )
-        time.sleep(3)
-        print(f"submit_jobs out: {h_out} \nsubmit_jobs err: {h_err}")
+    report_submission(h_out, h_err)
 
 
 if __name__ == "__main__":
 
+    # parse first, --help does not require the environment
+    get_args().parse_args()
+
     # require environment
-    env_found = [x for x in sys.path if "emuR01" in x]
-    if not env_found:
+    if not any("emuR01" in x for x in sys.path):
         print("\nERROR: madlab conda env emuR01 required.")
         print("\tHint: $madlab_env emuR01\n")
         sys.exit()
@@ -27,36 +27,41 @@ sbatch --job-name=runAshs \
 # %%
 import os
 import sys
-import glob
-import time
 import textwrap
-from datetime import datetime
-import subprocess
 from argparse import ArgumentParser, RawTextHelpFormatter
-import pandas as pd
+from func_processing.cli._discover import index_dset, index_tree
+from func_processing.cli._logs import load_log
+from func_processing.cli._sbatch import (
+    check_jobs,
+    make_slurm_dir,
+    report_submission,
+    submit,
+    wait_for_queue,
+    write_params,
+)
 
 
 # %%
 def submit_jobs(
-    subj,
     subj_dict,
-    subj_deriv,
-    subj_work,
+    deriv_dir,
+    scratch_dir,
+    sess,
     atlas_str,
     atlas_dir,
     sing_img,
     slurm_dir,
     code_dir,
 ):
-    """Run workflow.control_ashs for each subject.
+    """Run workflow.control_ashs for a batch of subjects.
 
-    Generate a parent job for each subject (p1234) to
-    govern child ashs jobs (ashs1234).
+    Submit cli/_ashs_runner.py for each subject as a task of a
+    single job array, each task governs the child ashs jobs
+    (ashs1234) of one subject. Tasks select their subject from
+    <slurm_dir>/subj_params.json via SLURM_ARRAY_TASK_ID.
 
     Parameters
     ----------
-    subj : str
-        BIDs subject string (sub-1234)
     subj_dict : dict
         {sub-1234:
             {
@@ -66,10 +71,12 @@ def submit_jobs(
                 t2-dir: /path/to/anat,
             }
         }
-    subj_deriv : str
-        path to desired output dir
-    subj_work : str
-        path to ashs working dir
+    deriv_dir : str
+        path to project ashs derivatives
+    scratch_dir : str
+        path to ashs working dirs
+    sess : str
+        BIDS session string (ses-S1)
     atlas_str : str
         ASHS atlas dir
     atlas_dir : str
@@ -85,48 +92,39 @@ def submit_jobs(
     -------
     (h_out, h_err) : duple
         stdout, stderr from sbatch subprocess submission of
-        subject control script
+        job array
     """
-    subj_num = subj.split("-")[-1]
-
-    h_cmd = f"""\
-        #!/bin/env {sys.executable}
-
-        #SBATCH --job-name=p{subj_num}
-        #SBATCH --output={slurm_dir}/out_{subj_num}.txt
-        #SBATCH --time=01:00:00
-        #SBATCH --mem=4000
-        #SBATCH --partition=IB_44C_512G
-        #SBATCH --account=iacc_madlab
-        #SBATCH --qos=pq_madlab
-
-        import sys
-        sys.path.append("{code_dir}")
-        from workflow import control_ashs
-
-        control_ashs.control_hipseg(
-            "{subj_dict[subj]["t1-dir"]}",
-            "{subj_dict[subj]["t2-dir"]}",
-            "{subj_deriv}",
-            "{subj_work}",
-            "{atlas_dir}",
-            "{sing_img}",
-            "{subj}",
-            "{subj_dict[subj]["t1-file"]}",
-            "{subj_dict[subj]["t2-file"]}",
-            "{atlas_str}",
-        )
-    """
-    cmd_dedent = textwrap.dedent(h_cmd)
-    py_script = os.path.join(slurm_dir, f"ashs_{subj_num}.py")
-    with open(py_script, "w") as h_script:
-        h_script.write(cmd_dedent)
-
-    sbatch_response = subprocess.Popen(
-        f"sbatch {py_script}", shell=True, stdout=subprocess.PIPE
+    # array index -> subject mapping, read by each task from slurm_dir
+    subj_params = [
+        {
+            "subj": subj,
+            "subj-deriv": os.path.join(deriv_dir, subj, sess),
+            "subj-work": os.path.join(scratch_dir, subj, sess),
+            **value_dict,
+        }
+        for subj, value_dict in subj_dict.items()
+    ]
+
+    subj_file = write_params(slurm_dir, "subj_params", subj_params)
+
+    # each array task runs cli/_ashs_runner.py for one subject
+    runner_cmd = [
+        sys.executable,
+        os.path.join(code_dir, "cli/_ashs_runner.py"),
+        f"--subj-params-file={subj_file}",
+        f"--atlas-dir={atlas_dir}",
+        f"--sing-img={sing_img}",
+        f"--atlas-str={atlas_str}",
+    ]
+
+    # run as an array of len(subj_dict)
+    return submit(
+        runner_cmd,
+        job_name="pAshs",
+        slurm_dir=slurm_dir,
+        time_limit="01:00:00",
+        array_size=len(subj_params),
     )
-    h_out, h_err = sbatch_response.communicate()
-    return (h_out, h_err)
 
 
 # %%
@@ -273,66 +271,100 @@ def main():
     dset_dir = os.path.join(proj_dir, "dset")
     deriv_dir = os.path.join(proj_dir, "derivatives/ashs")
 
-    # get completed logs
-    df_log = pd.read_csv(os.path.join(log_dir, "completed_preprocessing.tsv"), sep="\t")
+    # get completed logs, determine missing left ASHS for all subjects at once
+    df_log = load_log(log_dir, columns=["subjID", "ashs_L"])
+    ashs_missing_all = set(df_log.loc[df_log["ashs_L"].isnull(), "subjID"])
 
-    # make subject dict of those who need ASHS output
-    subj_list_all = df_log["subjID"].tolist()
-    subj_dict = {}
-    for subj in subj_list_all:
+    # find subjects with left ASHS output not yet in the logs, via one
+    # walk of deriv_dir (<subj>/<sess>/<subj>_left_lfseg_corr_usegray)
+    ashs_done = {
+        name.split("_")[0]
+        for name, h_path, is_dir in index_tree(deriv_dir, depth=3)
+        if not is_dir
+        and name.endswith("_left_lfseg_corr_usegray.nii.gz")
+        and os.path.basename(os.path.dirname(h_path)) == sess
+    }
 
-        # check log for missing left ASHS
+    # make subject dict of those who need ASHS output
+    def check_subject(subj, subj_files):
+        """Return {"t1-file": str, "t1-dir": str, ...} if subj needs work."""
         print(f"Checking {subj} for previous work ...")
-        ind_subj = df_log.index[df_log["subjID"] == subj]
-        ashs_missing = pd.isnull(df_log.loc[ind_subj, "ashs_L"]).bool()
-
-        # check for T1,2w files
-        t1_files = glob.glob(f"{dset_dir}/{subj}/**/*{t1_search}.nii*", recursive=True)
-        t2_files = glob.glob(f"{dset_dir}/{subj}/**/*{t2_search}.nii*", recursive=True)
-        if t1_files and t2_files and ashs_missing:
-
-            # give list item in list for field map correction, multiple acquisitions
-            print(f"\tAdding {subj} to working list (subj_dict).\n")
-            subj_dict[subj] = {}
-            subj_dict[subj]["t1-file"] = t1_files[-1].split("/")[-1]
-            subj_dict[subj]["t1-dir"] = t1_files[-1].rsplit("/", 1)[0]
-            subj_dict[subj]["t2-file"] = t2_files[-1].split("/")[-1]
-            subj_dict[subj]["t2-dir"] = t2_files[-1].rsplit("/", 1)[0]
+
+        # check for T1,2w files, index is sorted so [-1] is the last session
+        subj_names = [
+            (h_path, os.path.basename(h_path))
+            for h_path in subj_files
+            if not os.path.basename(h_path).startswith(".")
+        ]
+        t1_files = [x for x, name in subj_names if f"{t1_search}.nii" in name]
+        t2_files = [x for x, name in subj_names if f"{t2_search}.nii" in name]
+        if not t1_files or not t2_files:
+            return None
+
+        # give list item in list for field map correction, multiple acquisitions
+        print(f"\tAdding {subj} to working list (subj_dict).\n")
+        return {
+            "t1-file": t1_files[-1].split("/")[-1],
+            "t1-dir": t1_files[-1].rsplit("/", 1)[0],
+            "t2-file": t2_files[-1].split("/")[-1],
+            "t2-dir": t2_files[-1].rsplit("/", 1)[0],
+        }
+
+    # only subjects missing ASHS in both the log and deriv_dir need work,
+    # index their dset files a window at a time (reusing previous runs),
+    # and stop once a batch has been found
+    subj_list_all = [
+        x
+        for x in df_log["subjID"].tolist()
+        if x in ashs_missing_all and x not in ashs_done
+    ]
+    subj_dict = {}
+    window = 32
+    for ind in range(0, len(subj_list_all), window):
+        dset_index = index_dset(dset_dir, subj_list_all[ind : ind + window])
+        for subj, subj_files in dset_index.items():
+            subj_found = check_subject(subj, subj_files)
+            if subj_found:
+                subj_dict[subj] = subj_found
+        if len(subj_dict) >= batch_num:
+            break
 
     # kill while loop if all subjects have output
     if len(subj_dict.keys()) == 0:
         return
 
-    # submit jobs for N subjects that don't have output in deriv_dir
-    current_time = datetime.now()
-    slurm_dir = os.path.join(
+    # wait for previous batches to start, skip this batch if they do not
+    if not wait_for_queue("pAshs"):
+        print("Previous batch still pending, skipping this batch.")
+        return
+
+    # submit jobs for N subjects that don't have output in deriv_dir,
+    # as a single job array
+    slurm_dir = make_slurm_dir(scratch_dir, "ashs")
+    subj_batch = dict(list(subj_dict.items())[:batch_num])
+    print(f"Submitting jobs for {sess}:\n\t{' '.join(subj_batch)}\n")
+    job_out, h_err = submit_jobs(
+        subj_batch,
+        deriv_dir,
         scratch_dir,
-        f"""slurm_out/ashs_{current_time.strftime("%y-%m-%d_%H:%M")}""",
+        sess,
+        atlas_str,
+        atlas_dir,
+        sing_img,
+        slurm_dir,
+        code_dir,
     )
-    if not os.path.exists(slurm_dir):
-        os.makedirs(slurm_dir)
-
-    for subj in list(subj_dict)[:batch_num]:
-        job_out, _ = submit_jobs(
-            subj,
-            subj_dict,
-            os.path.join(deriv_dir, subj, sess),
-            os.path.join(scratch_dir, subj, sess),
-            atlas_str,
-            atlas_dir,
-            sing_img,
-            slurm_dir,
-            code_dir,
-        )
-        print(job_out)
-        time.sleep(3)
+    if report_submission(job_out, h_err):
+        check_jobs([job_out])
 
 
 if __name__ == "__main__":
 
+    # parse first, --help does not require the environment
+    get_args().parse_args()
+
     # require environment
-    env_found = [x for x in sys.path if "emuR01" in x]
-    if not env_found:
+    if not any("emuR01" in x for x in sys.path):
         print("\nERROR: madlab conda env emuR01 or emuR01_unc required.")
         print("\tHint: $madlab_env emuR01\n")
         sys.exit()
@@ -89,10 +89,12 @@ def main():
 
 if __name__ == "__main__":
 
+    # parse first, --help does not require the environment
+    get_args().parse_args()
+
     # require environment for HPC (linux) only
     if sys.platform == "linux":
-        env_found = [x for x in sys.path if "emuR01" in x]
-        if not env_found:
+        if not any("emuR01" in x for x in sys.path):
             print("\nERROR: madlab conda env emuR01 required.")
             print("\tHint: $madlab_env emuR01\n")
             sys.exit()
@@ -28,18 +28,23 @@ sbatch --job-name=runPrep \
 # %%
 import os
 import sys
-import glob
-import fnmatch
-import time
+import itertools
 import textwrap
-from datetime import datetime
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import shutil
 from argparse import ArgumentParser, RawTextHelpFormatter
+from func_processing.cli._discover import index_tree, iter_subjects, list_subjects
+from func_processing.cli._sbatch import (
+    make_slurm_dir,
+    report_submission,
+    submit,
+    write_params,
+)
 
 
 # %%
 def submit_jobs(
-    subj,
+    subj_list,
     proj_dir,
     scratch_dir,
     sing_img,
@@ -50,10 +55,14 @@ def submit_jobs(
 ):
     """Schedule workflow jobs with slurm.
 
+    Submit cli/_fmriprep_runner.py for each subject as a task of
+    a single job array, each array task selects its subject from
+    <slurm_dir>/subj_params.json via SLURM_ARRAY_TASK_ID.
+
     Parameters
     ----------
-    subj : str
-        BIDS subject string
+    subj_list : list
+        BIDS subject strings
     proj_dir : str
         Path to BIDS project directory
     scratch_dir : str
@@ -74,65 +83,29 @@ def submit_jobs(
     tuple
         stdout, stderr
     """
-    # generate workflow script
-    subj_num = subj.split("-")[-1]
-    h_cmd = f"""\
-        #!/bin/env {sys.executable}
-
-        #SBATCH --job-name=p{subj_num}
-        #SBATCH --output={slurm_dir}/out_{subj_num}.txt
-        #SBATCH --time=20:00:00
-        #SBATCH --mem=4000
-        #SBATCH --partition=IB_44C_512G
-        #SBATCH --account=iacc_madlab
-        #SBATCH --qos=pq_madlab
-
-        import sys
-        import os
-        import subprocess
-        import shutil
-        sys.path.append("{code_dir}")
-        from workflow import control_fmriprep
-
-        path_dict = control_fmriprep.control_fmriprep(
-            "{subj}",
-            "{proj_dir}",
-            "{scratch_dir}",
-            "{sing_img}",
-            "{tplflow_dir}",
-            "{fs_license}",
-        )
-
-        # copy freesurfer data to project directory
-        subj_fsurf = os.path.join(path_dict["scratch-fsurf"], "{subj}")
-        h_cmd = f"cp -r {{subj_fsurf}} {{path_dict['proj-deriv']}}/freesurfer"
-        h_cp = subprocess.Popen(h_cmd, shell=True, stdout=subprocess.PIPE)
-        h_cp.communicate()
-
-        # copy fmriprep data to project directory
-        subj_fprep = os.path.join(path_dict["scratch-fprep"], "{subj}")
-        h_cmd = f"cp -r {{subj_fprep}}* {{path_dict['proj-deriv']}}/fmriprep"
-        h_cp = subprocess.Popen(h_cmd, shell=True, stdout=subprocess.PIPE)
-        h_cp.communicate()
-
-        # turn out the lights
-        shutil.rmtree(subj_fsurf)
-        shutil.rmtree(subj_fprep)
-        shutil.rmtree(path_dict["scratch-work"])
-    """
-
-    # write script for review
-    cmd_dedent = textwrap.dedent(h_cmd)
-    py_script = os.path.join(slurm_dir, f"fmriprep_{subj_num}.py")
-    with open(py_script, "w") as h_script:
-        h_script.write(cmd_dedent)
-
-    # execute script
-    sbatch_response = subprocess.Popen(
-        f"sbatch {py_script}", shell=True, stdout=subprocess.PIPE
+    subj_file = write_params(slurm_dir, "subj_params", subj_list)
+
+    # each array task runs cli/_fmriprep_runner.py for one subject
+    runner_cmd = [
+        sys.executable,
+        os.path.join(code_dir, "cli/_fmriprep_runner.py"),
+        f"--subj-params-file={subj_file}",
+        f"--log-dir={slurm_dir}",
+        f"--proj-dir={proj_dir}",
+        f"--scratch-dir={scratch_dir}",
+        f"--sing-img={sing_img}",
+        f"--tplflow-dir={tplflow_dir}",
+        f"--fs-license={fs_license}",
+    ]
+
+    # execute as an array of len(subj_list)
+    return submit(
+        runner_cmd,
+        job_name="pPrep",
+        slurm_dir=slurm_dir,
+        time_limit="20:00:00",
+        array_size=len(subj_list),
     )
-    h_out, h_err = sbatch_response.communicate()
-    return (h_out, h_err)
 
 
 # %%
@@ -206,6 +179,16 @@ def get_args():
             """
         ),
     )
+    parser.add_argument(
+        "--unsorted",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+            check subjects in the order dset is read, rather than
+            sorted (faster to first submission on large dsets)
+            """
+        ),
+    )
 
     required_args = parser.add_argument_group("Required Arguments")
     required_args.add_argument(
@@ -234,73 +217,87 @@ def main():
     fs_license = args.fs_license
     batch_num = args.batch_num
     code_dir = args.code_dir
+    unsorted = args.unsorted
 
     # set up - get subject lists and make scratch dirs
     dset_dir = os.path.join(proj_dir, "dset")
-    subj_list_all = [x for x in os.listdir(dset_dir) if fnmatch.fnmatch(x, "sub-*")]
-    subj_list_all.sort()
+    if unsorted:
+        subj_iter = iter_subjects(dset_dir)
+    else:
+        subj_iter = iter(list_subjects(dset_dir))
 
     scratch_deriv = os.path.join(scratch_dir, "derivatives")
     scratch_dset = os.path.join(scratch_dir, "dset")
     for h_dir in [scratch_deriv, scratch_dset]:
-        if not os.path.exists(h_dir):
-            os.makedirs(h_dir)
+        os.makedirs(h_dir, exist_ok=True)
 
     # patch - combat /scratch purge by updating templateflow dir
     print(f"\nCombating /scratch purge of {tplflow_dir} ...\n")
-    h_cmd = f"cp -r /home/data/madlab/atlases/templateflow/* {tplflow_dir}/"
-    h_cp = subprocess.Popen(h_cmd, shell=True, stdout=subprocess.PIPE)
-    h_cp.communicate()
+    tplflow_src = "/home/data/madlab/atlases/templateflow"
+    for name, path, is_dir in index_tree(tplflow_src, depth=1):
+        if name.startswith("."):
+            continue
+        h_dst = os.path.join(tplflow_dir, name)
+        if is_dir:
+            shutil.copytree(path, h_dst, copy_function=shutil.copy, dirs_exist_ok=True)
+        else:
+            shutil.copy(path, h_dst)
 
     # make subject dict of those who need fMRIprep output
-    subj_list = []
-    for subj in subj_list_all:
-
-        # check for missing fMRIprep output
+    def check_subject(subj):
+        """Return subj if fMRIprep output is missing, else None."""
         print(f"Checking {subj} for previous work ...")
         subj_fmriprep = os.path.join(proj_dir, "derivatives/fmriprep", subj)
-        t1_exists = glob.glob(
-            f"{subj_fmriprep}/**/*desc-preproc_T1w.nii.gz", recursive=True
+        t1_exists = any(
+            name.endswith("desc-preproc_T1w.nii.gz")
+            for name, _, is_dir in index_tree(subj_fmriprep, depth=3)
+            if not is_dir
         )
         if not t1_exists:
             print(f"\tAdding {subj} to working list (subj_list).\n")
-            subj_list.append(subj)
+            return subj
+        return None
+
+    # checks are filesystem bound, overlap them across a window of
+    # subjects as dset is read, and stop once a batch has been found
+    subj_list = []
+    num_workers = 32
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        while len(subj_list) < batch_num:
+            h_list = list(itertools.islice(subj_iter, num_workers))
+            if not h_list:
+                break
+            subj_list.extend(x for x in executor.map(check_subject, h_list) if x)
 
     # kill while loop if all subjects have output
     if len(subj_list) == 0:
         print("No subjects needing fMRIprep detected, exiting.")
         return
-    print(f"Submitting jobs for:\n\t {' '.join(subj_list)}\n")
+    print(f"Submitting jobs for:\n\t {' '.join(subj_list[:batch_num])}\n")
 
     # submit jobs for N subjects that don't have output in deriv_dir
-    current_time = datetime.now()
-    slurm_dir = os.path.join(
+    slurm_dir = make_slurm_dir(scratch_dir, "fmriprep")
+
+    job_out, h_err = submit_jobs(
+        subj_list[:batch_num],
+        proj_dir,
         scratch_dir,
-        f"""slurm_out/fmriprep_{current_time.strftime("%y-%m-%d_%H:%M")}""",
+        sing_img,
+        tplflow_dir,
+        fs_license,
+        slurm_dir,
+        code_dir,
     )
-    if not os.path.exists(slurm_dir):
-        os.makedirs(slurm_dir)
-
-    for subj in subj_list[:batch_num]:
-        job_out, _ = submit_jobs(
-            subj,
-            proj_dir,
-            scratch_dir,
-            sing_img,
-            tplflow_dir,
-            fs_license,
-            slurm_dir,
-            code_dir,
-        )
-        print(job_out)
-        time.sleep(3)
+    report_submission(job_out, h_err)
 
 
 if __name__ == "__main__":
 
+    # parse first, --help does not require the environment
+    get_args().parse_args()
+
     # require environment
-    env_found = [x for x in sys.path if "emuR01" in x]
-    if not env_found:
+    if not any("emuR01" in x for x in sys.path):
         print("\nERROR: madlab conda env emuR01 required.")
         print("\tHint: $madlab_env emuR01\n")
         sys.exit()
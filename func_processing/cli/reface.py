@@ -21,29 +21,33 @@ sbatch --job-name=runReface \
 # %%
 import os
 import sys
-import glob
-import time
-import subprocess
 import textwrap
-from datetime import datetime
 from argparse import ArgumentParser, RawTextHelpFormatter
-import pandas as pd
+from func_processing.cli._discover import index_dset
+from func_processing.cli._logs import load_log
+from func_processing.cli._sbatch import (
+    check_jobs,
+    make_slurm_dir,
+    report_submission,
+    submit,
+    wait_for_queue,
+    write_params,
+)
 
 
 # %%
-def submit_jobs(subj, sess, t1_file, proj_dir, method, code_dir, slurm_dir):
-    """Submit refacing workflow.
+def submit_jobs(subj_dict, proj_dir, method, code_dir, slurm_dir):
+    """Submit refacing workflow for a batch of subjects.
 
-    Also writes a python script to slurm_dir for review.
+    Submit cli/_reface_runner.py for each subject as a task of a
+    single job array, each task re/defaces one subject. Tasks select
+    their subject from <slurm_dir>/subj_params.json via
+    SLURM_ARRAY_TASK_ID.
 
     Parameters
     ----------
-    subj : str
-        BIDS subject string (sub-1234)
-    sess : str
-        BIDS session string (ses-A)
-    t1_file : str
-        file name of T1w file (sub-1234_ses-A_T1w.nii.gz)
+    subj_dict : dict
+        {sub-1234: {"sess": ses-A, "anat": sub-1234_ses-A_T1w.nii.gz}}
     proj_dir : str
         BIDS project directory (/path/to/proj)
     method : str
@@ -56,44 +60,32 @@ def submit_jobs(subj, sess, t1_file, proj_dir, method, code_dir, slurm_dir):
     Returns
     -------
     h_out, h_err : str
-        stdout, stderr of sbatch submission
+        stdout, stderr of sbatch submission of job array
     """
-    subj_num = subj.split("-")[-1]
-
-    h_cmd = f"""\
-        #!/bin/env {sys.executable}
-
-        #SBATCH --job-name=d{subj_num}
-        #SBATCH --output={slurm_dir}/out_{subj_num}.txt
-        #SBATCH --time=01:00:00
-        #SBATCH --mem=4000
-        #SBATCH --partition=IB_44C_512G
-        #SBATCH --account=iacc_madlab
-        #SBATCH --qos=pq_madlab
-
-        import sys
-        sys.path.append("{code_dir}")
-        from workflow import control_reface
-
-        msg_out = control_reface.control_reface(
-            "{subj}",
-            "{sess}",
-            "{t1_file}",
-            "{proj_dir}",
-            "{method}",
-        )
-        print(msg_out)
-    """
-    cmd_dedent = textwrap.dedent(h_cmd)
-    py_script = os.path.join(slurm_dir, f"reface_{subj_num}.py")
-    with open(py_script, "w") as h_script:
-        h_script.write(cmd_dedent)
-
-    sbatch_response = subprocess.Popen(
-        f"sbatch {py_script}", shell=True, stdout=subprocess.PIPE
+    # array index -> subject mapping, read by each task from slurm_dir
+    subj_params = [
+        {"subj": subj, **value_dict} for subj, value_dict in subj_dict.items()
+    ]
+
+    subj_file = write_params(slurm_dir, "subj_params", subj_params)
+
+    # each array task runs cli/_reface_runner.py for one subject
+    runner_cmd = [
+        sys.executable,
+        os.path.join(code_dir, "cli/_reface_runner.py"),
+        f"--subj-params-file={subj_file}",
+        f"--proj-dir={proj_dir}",
+        f"--method={method}",
+    ]
+
+    # run as an array of len(subj_dict)
+    return submit(
+        runner_cmd,
+        job_name="dReface",
+        slurm_dir=slurm_dir,
+        time_limit="01:00:00",
+        array_size=len(subj_params),
     )
-    h_out, h_err = sbatch_response.communicate()
-    return (h_out, h_err)
 
 
 # %%
@@ -167,65 +159,73 @@ def main():
     )
     dset_dir = os.path.join(proj_dir, "dset")
     deriv_dir = os.path.join(proj_dir, f"derivatives/{method}")
-    if not os.path.exists(deriv_dir):
-        os.makedirs(deriv_dir)
+    os.makedirs(deriv_dir, exist_ok=True)
 
-    # get completed logs
-    df_log = pd.read_csv(os.path.join(log_dir, "completed_preprocessing.tsv"), sep="\t")
+    # get completed logs, determine missing re/deface for all subjects at once
+    df_log = load_log(log_dir, columns=["subjID", "reface"])
+    reface_missing_all = df_log.set_index("subjID")["reface"].isnull()
 
     # make subject dict of those who need defaced output
-    subj_list_all = df_log["subjID"].tolist()
-    subj_dict = {}
-    for subj in subj_list_all:
+    def check_subject(subj, subj_files):
+        """Return {"sess": str, "anat": str} if subj needs work."""
+        print(f"Checking {subj} for previous work ...")
 
         # check for t1 file
-        print(f"Checking {subj} for previous work ...")
-        t1_files = sorted(glob.glob(f"{dset_dir}/{subj}/**/*T1w.nii*", recursive=True))
+        t1_files = [
+            h_path
+            for h_path in subj_files
+            if "T1w.nii" in os.path.basename(h_path)
+            and not os.path.basename(h_path).startswith(".")
+        ]
+        if not t1_files:
+            return None
         t1_file = t1_files[-1].split("/")[-1]
         sess = t1_file.split("_")[1]
 
-        # check log for missing re/deface
-        ind_subj = df_log.index[df_log["subjID"] == subj]
-        reface_missing = pd.isnull(df_log.loc[ind_subj, "reface"]).bool()
+        print(f"\tAdding {subj} to working list (subj_dict).\n")
+        return {"sess": sess, "anat": t1_file}
 
-        if t1_files and reface_missing:
-            print(f"\tAdding {subj} to working list (subj_dict).\n")
-            subj_dict[subj] = {}
-            subj_dict[subj]["sess"] = sess
-            subj_dict[subj]["anat"] = t1_file
+    # only subjects missing re/deface in the log need work, index their
+    # dset files a window at a time (reusing previous runs), and stop once
+    # a batch has been found
+    subj_list_all = reface_missing_all.index[reface_missing_all].tolist()
+    subj_dict = {}
+    window = 32
+    for ind in range(0, len(subj_list_all), window):
+        dset_index = index_dset(dset_dir, subj_list_all[ind : ind + window])
+        for subj, subj_files in dset_index.items():
+            subj_found = check_subject(subj, subj_files)
+            if subj_found:
+                subj_dict[subj] = subj_found
+        if len(subj_dict) >= batch_num:
+            break
 
     # kill while loop if all subjects have output
     if len(subj_dict.keys()) == 0:
         return
 
-    # submit jobs for N subjects that don't have output in deriv_dir
-    current_time = datetime.now()
-    slurm_dir = os.path.join(
-        scratch_dir,
-        f"""slurm_out/reface_{current_time.strftime("%y-%m-%d_%H:%M")}""",
-    )
-    if not os.path.exists(slurm_dir):
-        os.makedirs(slurm_dir)
-
-    for subj in list(subj_dict)[:batch_num]:
-        job_out, _ = submit_jobs(
-            subj,
-            subj_dict[subj]["sess"],
-            subj_dict[subj]["anat"],
-            proj_dir,
-            method,
-            code_dir,
-            slurm_dir,
-        )
-        print(f"{method} {subj} with job: {job_out}")
-        time.sleep(3)
+    # wait for previous batches to start, skip this batch if they do not
+    if not wait_for_queue("dReface"):
+        print("Previous batch still pending, skipping this batch.")
+        return
+
+    # submit jobs for N subjects that don't have output in deriv_dir,
+    # as a single job array
+    slurm_dir = make_slurm_dir(scratch_dir, "reface")
+    subj_batch = dict(list(subj_dict.items())[:batch_num])
+    print(f"Submitting {method} jobs for:\n\t{' '.join(subj_batch)}\n")
+    job_out, h_err = submit_jobs(subj_batch, proj_dir, method, code_dir, slurm_dir)
+    if report_submission(job_out, h_err):
+        check_jobs([job_out])
 
 
 if __name__ == "__main__":
 
+    # parse first, --help does not require the environment
+    get_args().parse_args()
+
     # require environment
-    env_found = [x for x in sys.path if "emuR01" in x]
-    if not env_found:
+    if not any("emuR01" in x for x in sys.path):
         print("\nERROR: madlab conda env emuR01 required.")
         print("\tHint: $madlab_env emuR01\n")
         sys.exit()
@@ -86,26 +86,36 @@ def submit_hpc_sbatch(
     -------
     submit_hpc_sbatch("afni -ver")
     """
-    sbatch_job = f"""
-        sbatch \
-        -J {job_name} \
-        -t {wall_hours}:00:00 \
-        --cpus-per-task={num_proc} \
-        --mem-per-cpu={mem_gig}000 \
-        -p IB_44C_512G \
-        -o {out_dir}/{job_name}.out \
-        -e {out_dir}/{job_name}.err \
-        --account iacc_madlab --qos pq_madlab \
-        --wait \
-        --wrap="module load afni-20.2.06
+    sbatch_job = [
+        "sbatch",
+        "-J",
+        job_name,
+        "-t",
+        f"{wall_hours}:00:00",
+        f"--cpus-per-task={num_proc}",
+        f"--mem-per-cpu={mem_gig}000",
+        "-p",
+        "IB_44C_512G",
+        "-o",
+        f"{out_dir}/{job_name}.out",
+        "-e",
+        f"{out_dir}/{job_name}.err",
+        "--account",
+        "iacc_madlab",
+        "--qos",
+        "pq_madlab",
+        "--wait",
+        f"""--wrap=module load afni-20.2.06
             module load c3d-1.0.0-gcc-8.2.0
             {command}
-        "
-    """
+        """,
+    ]
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
+
+    # sbatch is executed directly, the wrapped command is run by the job shell
     sbatch_response = subprocess.Popen(
-        sbatch_job, shell=True, stdout=subprocess.PIPE, env=env_input
+        sbatch_job, stdout=subprocess.PIPE, env=env_input
     )
     job_id = sbatch_response.communicate()[0].decode("utf-8")
     return (job_name, job_id)
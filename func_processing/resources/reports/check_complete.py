@@ -8,7 +8,6 @@ import os
 import time
 import datetime
 import glob
-import fnmatch
 import io
 import git
 import requests
@@ -187,14 +186,17 @@ def check_preproc(proj_dir, code_dir, pat_github_emu, new_df, one_subj=False):
     if one_subj:
         subj_list = [one_subj]
     else:
-        subj_list_all = sorted(
-            [x for x in os.listdir(dset_dir) if fnmatch.fnmatch(x, "sub-*")]
-        )
+        with os.scandir(dset_dir) as dset_iter:
+            subj_list_all = sorted(
+                x.name
+                for x in dset_iter
+                if x.name.startswith("sub-") and x.is_dir(follow_symlinks=False)
+            )
         df_guid["comments"] = df_guid["comments"].fillna("nan")
-        exclude_list = [
+        exclude_list = {
             f"sub-{x}" for x in df_guid[df_guid["exclude"].notnull()]["redcap_id"]
-        ]
-        subj_guid = [f"sub-{x}" for x in df_guid["redcap_id"]]
+        }
+        subj_guid = {f"sub-{x}" for x in df_guid["redcap_id"]}
         subj_list = [
             x for x in subj_list_all if x not in exclude_list and x in subj_guid
         ]
@@ -0,0 +1,498 @@
+"""Test helper modules of the cli scripts.
+
+Covers moving output between filesystems, parsing sbatch/squeue/sacct
+output, indexing of dset and its discovery cache, the log cache,
+and archiving of node-local job logs.
+
+Examples
+--------
+python -m pytest func_processing/tests/test_cli_helpers.py
+"""
+import os
+import sys
+import gzip
+import json
+import errno
+import shutil
+import signal
+import subprocess
+import pytest
+import pandas as pd
+from func_processing.cli import _move
+from func_processing.cli import _sbatch
+from func_processing.cli import _discover
+from func_processing.cli import afni_resting_group
+from func_processing.cli._logs import load_log
+from func_processing.cli.afni_task_subj import index_decon_plans
+
+
+# %%
+def _make_files(root, rel_list):
+    """Make an empty file for each relative path in rel_list."""
+    for rel_path in rel_list:
+        h_path = os.path.join(root, rel_path)
+        os.makedirs(os.path.dirname(h_path), exist_ok=True)
+        with open(h_path, "w") as h_file:
+            h_file.write(rel_path)
+
+
+def _list_tree(root):
+    """Return sorted relative paths of all files beneath root."""
+    return sorted(
+        os.path.relpath(os.path.join(h_root, h_file), root)
+        for h_root, _, h_files in os.walk(root)
+        for h_file in h_files
+    )
+
+
+# %%
+def test_move_tree_rename(tmp_path):
+    src = tmp_path / "scratch" / "sub-1"
+    dst = tmp_path / "project" / "sub-1"
+    _make_files(src, ["ses-A/func/a.nii.gz", "ses-A/anat/b.nii.gz"])
+
+    _move.move_tree(str(src), str(dst))
+    assert not src.exists()
+    assert _list_tree(dst) == ["ses-A/anat/b.nii.gz", "ses-A/func/a.nii.gz"]
+
+
+def test_move_tree_merge(tmp_path):
+    src = tmp_path / "scratch" / "sub-1"
+    dst = tmp_path / "project" / "sub-1"
+    _make_files(src, ["ses-B/func/a.nii.gz", "ses-A/func/new.1D"])
+    _make_files(dst, ["ses-A/func/a.nii.gz"])
+
+    _move.move_tree(str(src), str(dst))
+    assert not src.exists()
+    assert _list_tree(dst) == [
+        "ses-A/func/a.nii.gz",
+        "ses-A/func/new.1D",
+        "ses-B/func/a.nii.gz",
+    ]
+
+
+def test_move_tree_exdev(tmp_path, monkeypatch):
+    src = tmp_path / "scratch" / "sub-1"
+    dst = tmp_path / "project" / "sub-1"
+    _make_files(src, ["ses-A/func/a.nii.gz"])
+    _make_files(dst, ["ses-B/func/a.nii.gz"])
+
+    def fake_rename(h_src, h_dst):
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+    rsync_calls = []
+
+    def fake_rsync(cmd, check):
+        # copy as rsync would, removing source files but not directories
+        rsync_calls.append(cmd)
+        h_src, h_dst = cmd[-2].rstrip("/"), cmd[-1].rstrip("/")
+        shutil.copytree(h_src, h_dst, dirs_exist_ok=True)
+        for h_root, _, h_files in os.walk(h_src):
+            for h_file in h_files:
+                os.remove(os.path.join(h_root, h_file))
+
+    monkeypatch.setattr(_move.os, "rename", fake_rename)
+    monkeypatch.setattr(_move.subprocess, "run", fake_rsync)
+
+    _move.move_tree(str(src), str(dst))
+    assert len(rsync_calls) == 1
+    assert rsync_calls[0][0] == "rsync"
+    assert "--remove-source-files" in rsync_calls[0]
+    assert not src.exists()
+    assert _list_tree(dst) == ["ses-A/func/a.nii.gz", "ses-B/func/a.nii.gz"]
+
+
+def test_move_tree_other_error(tmp_path, monkeypatch):
+    src = tmp_path / "scratch" / "sub-1"
+    _make_files(src, ["ses-A/func/a.nii.gz"])
+
+    def fake_rename(h_src, h_dst):
+        raise OSError(errno.EACCES, os.strerror(errno.EACCES))
+
+    monkeypatch.setattr(_move.os, "rename", fake_rename)
+    with pytest.raises(PermissionError):
+        _move.move_tree(str(src), str(tmp_path / "project" / "sub-1"))
+    assert src.exists()
+
+
+# %%
+@pytest.mark.parametrize(
+    "h_out, h_id",
+    [
+        (b"1234\n", "1234"),
+        (b"1234;cluster\n", "1234"),
+        (b"", None),
+        (b"\n", None),
+    ],
+)
+def test_job_id(h_out, h_id):
+    assert _sbatch.job_id(h_out) == h_id
+
+
+def _fake_tool(bin_dir, name, stdout):
+    """Write an executable to bin_dir which prints stdout, return its path."""
+    h_path = os.path.join(bin_dir, name)
+    with open(h_path, "w") as h_file:
+        h_file.write(f"#!/bin/sh\nprintf '{stdout}'\n")
+    os.chmod(h_path, 0o755)
+    return h_path
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    """Skip check_jobs retry waits, record them instead."""
+    sleep_calls = []
+    monkeypatch.setattr(_sbatch.time, "sleep", sleep_calls.append)
+    return sleep_calls
+
+
+def test_check_jobs_squeue(tmp_path, monkeypatch, no_sleep):
+    squeue = _fake_tool(tmp_path, "squeue", "11|RUNNING\\n12_0|PENDING\\n")
+    sacct = _fake_tool(tmp_path, "sacct", "")
+    monkeypatch.setattr(_sbatch, "_SQUEUE", squeue)
+    monkeypatch.setattr(_sbatch, "_SACCT", sacct)
+
+    assert _sbatch.check_jobs([b"11;cluster\n", b"12\n"]) == {}
+    assert no_sleep == []
+
+
+def test_check_jobs_sacct(tmp_path, monkeypatch, no_sleep):
+    squeue = _fake_tool(tmp_path, "squeue", "11|RUNNING\\n")
+    sacct = _fake_tool(
+        tmp_path, "sacct", "12_0|FAILED\\n12_1|COMPLETED\\n13|CANCELLED by 0\\n"
+    )
+    monkeypatch.setattr(_sbatch, "_SQUEUE", squeue)
+    monkeypatch.setattr(_sbatch, "_SACCT", sacct)
+
+    bad_jobs = _sbatch.check_jobs([b"11\n", b"12\n", b"13\n", b""])
+    assert bad_jobs == {"12": "FAILED", "13": "CANCELLED"}
+    assert no_sleep == []
+
+
+def test_check_jobs_not_found(tmp_path, monkeypatch, no_sleep):
+    squeue = _fake_tool(tmp_path, "squeue", "")
+    sacct = _fake_tool(tmp_path, "sacct", "")
+    monkeypatch.setattr(_sbatch, "_SQUEUE", squeue)
+    monkeypatch.setattr(_sbatch, "_SACCT", sacct)
+
+    assert _sbatch.check_jobs([b"11\n"], retries=2) == {"11": "NOT FOUND"}
+    assert no_sleep == [1, 2]
+
+
+def test_check_jobs_no_accounting(tmp_path, monkeypatch, no_sleep):
+    squeue = _fake_tool(tmp_path, "squeue", "11|COMPLETING\\n")
+    monkeypatch.setattr(_sbatch, "_SQUEUE", squeue)
+    monkeypatch.setattr(_sbatch, "_SACCT", str(tmp_path / "missing"))
+
+    assert _sbatch.check_jobs([b"11\n", b"12\n"]) == {}
+    monkeypatch.setattr(_sbatch, "_SQUEUE", str(tmp_path / "missing"))
+    assert _sbatch.check_jobs([b"11\n"]) == {}
+
+
+def test_array_task(tmp_path, monkeypatch):
+    subj_params = [{"subj": "sub-1"}, {"subj": "sub-2"}]
+    subj_file = _sbatch.write_params(str(tmp_path), "subj_params", subj_params)
+    assert subj_file == str(tmp_path / "subj_params.json")
+    monkeypatch.setenv("SLURM_ARRAY_TASK_ID", "1")
+    assert _sbatch.array_task(subj_file) == {"subj": "sub-2"}
+
+
+def test_submit_large_params(tmp_path, monkeypatch):
+    # group data beyond the 128 KiB limit of a single argument
+    group_data = {"ztrans": [f"/path/to/sub-{x:05d}/ztrans" for x in range(8000)]}
+    assert len(json.dumps(group_data)) > 128 * 1024
+    sbatch = tmp_path / "sbatch"
+    with open(sbatch, "w") as h_file:
+        h_file.write('#!/bin/sh\necho "$@" >&2\necho 11\n')
+    os.chmod(sbatch, 0o755)
+    monkeypatch.setattr(_sbatch, "_SBATCH", str(sbatch))
+
+    slurm_dir = _sbatch.make_slurm_dir(str(tmp_path), "afni")
+    h_out, h_err = afni_resting_group.submit_jobs(
+        "rPCC", "task-rest", "/afni", "/group", group_data, slurm_dir, "/code", False
+    )
+    assert _sbatch.job_id(h_out) == "11"
+    group_file = os.path.join(slurm_dir, "group_data.json")
+    assert f"--group-json-file={group_file}" in h_err.decode()
+    assert _sbatch.read_params(group_file) == group_data
+
+
+def test_make_slurm_dir(tmp_path):
+    slurm_dir = _sbatch.make_slurm_dir(str(tmp_path), "afni")
+    assert os.path.isdir(slurm_dir)
+    assert os.path.dirname(slurm_dir) == str(tmp_path / "slurm_out")
+    assert os.path.basename(slurm_dir).endswith(f"_{os.getpid()}")
+    with pytest.raises(FileExistsError):
+        os.makedirs(slurm_dir)
+
+
+# %%
+def test_index_tree_depth(tmp_path):
+    _make_files(tmp_path, ["sub-1/ses-A/anat/T1w.nii.gz", "sub-1/top.json"])
+
+    found = {
+        os.path.relpath(h_path, tmp_path): is_dir
+        for _, h_path, is_dir in _discover.index_tree(str(tmp_path), depth=2)
+    }
+    assert found == {"sub-1": True, "sub-1/ses-A": True, "sub-1/top.json": False}
+
+    found = [
+        os.path.relpath(h_path, tmp_path)
+        for _, h_path, is_dir in _discover.index_tree(str(tmp_path), depth=4)
+        if not is_dir
+    ]
+    assert sorted(found) == ["sub-1/ses-A/anat/T1w.nii.gz", "sub-1/top.json"]
+
+
+def test_index_tree_missing(tmp_path):
+    assert list(_discover.index_tree(str(tmp_path / "missing"))) == []
+
+
+@pytest.fixture
+def dset_dir(tmp_path, monkeypatch):
+    """Make a dset, keep the discovery cache in tmp_path."""
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    dset_dir = tmp_path / "dset"
+    _make_files(
+        dset_dir,
+        [
+            "sub-1/ses-A/anat/sub-1_ses-A_T1w.nii.gz",
+            "sub-2/ses-A/anat/sub-2_ses-A_T1w.nii.gz",
+        ],
+    )
+    return str(dset_dir)
+
+
+def test_index_dset(dset_dir):
+    dset_index = _discover.index_dset(dset_dir, ["sub-1", "sub-2", "sub-3"])
+    assert sorted(dset_index) == ["sub-1", "sub-2"]
+    assert dset_index["sub-1"] == [
+        os.path.join(dset_dir, "sub-1/ses-A/anat/sub-1_ses-A_T1w.nii.gz")
+    ]
+    assert os.path.exists(_discover._cache_path(["dset", dset_dir, 3]))
+
+
+def test_index_dset_cached(dset_dir, monkeypatch):
+    _discover.index_dset(dset_dir, ["sub-1", "sub-2"])
+
+    def fail_scan(subj_dir, depth):
+        raise AssertionError(f"{subj_dir} walked again")
+
+    monkeypatch.setattr(_discover, "_scan_subject", fail_scan)
+    dset_index = _discover.index_dset(dset_dir, ["sub-1", "sub-2"])
+    assert sorted(dset_index) == ["sub-1", "sub-2"]
+
+
+def test_index_dset_invalidate(dset_dir):
+    _discover.index_dset(dset_dir, ["sub-1", "sub-2"])
+
+    # new file changes the mtime of its directory
+    anat_dir = os.path.join(dset_dir, "sub-1/ses-A/anat")
+    _make_files(anat_dir, ["sub-1_ses-A_run-2_T1w.nii.gz"])
+    h_mtime = os.stat(anat_dir).st_mtime_ns + 1_000_000_000
+    os.utime(anat_dir, ns=(h_mtime, h_mtime))
+
+    # removed subject is dropped
+    shutil.rmtree(os.path.join(dset_dir, "sub-2"))
+
+    dset_index = _discover.index_dset(dset_dir, ["sub-1", "sub-2"])
+    assert sorted(dset_index) == ["sub-1"]
+    assert len(dset_index["sub-1"]) == 2
+    assert _discover.read_cache(["dset", dset_dir, 3]).keys() == {"sub-1"}
+
+
+@pytest.mark.parametrize(
+    "cache_text",
+    ["{", "[]", '{"key": ["other"], "result": {}}', '{"key": null}'],
+)
+def test_index_dset_corrupt_cache(dset_dir, cache_text):
+    cache_key = ["dset", dset_dir, 3]
+    cache_file = _discover._cache_path(cache_key)
+    os.makedirs(os.path.dirname(cache_file))
+    with open(cache_file, "w") as jf:
+        jf.write(cache_text)
+
+    assert _discover.read_cache(cache_key) is None
+    dset_index = _discover.index_dset(dset_dir, ["sub-1"])
+    assert list(dset_index) == ["sub-1"]
+    assert list(_discover.read_cache(cache_key)) == ["sub-1"]
+
+
+def test_index_dset_malformed_entry(dset_dir):
+    cache_key = ["dset", dset_dir, 3]
+    _discover.write_cache(cache_key, {"sub-1": {"dirs": []}, "sub-2": None})
+
+    dset_index = _discover.index_dset(dset_dir, ["sub-1", "sub-2"])
+    assert sorted(dset_index) == ["sub-1", "sub-2"]
+
+
+# %%
+@pytest.fixture
+def log_dir(tmp_path):
+    """Make a completed_preprocessing log."""
+    with open(tmp_path / "completed_preprocessing.tsv", "w") as h_file:
+        h_file.write("subjID\treface\nsub-1\t1\nsub-2\t\n")
+    return str(tmp_path)
+
+
+def _set_mtime(h_path, h_time):
+    os.utime(h_path, (h_time, h_time))
+
+
+def test_load_log_writes_cache(log_dir):
+    df_log = load_log(log_dir, columns=["subjID"])
+    assert list(df_log.columns) == ["subjID"]
+    assert df_log["subjID"].tolist() == ["sub-1", "sub-2"]
+    assert sorted(os.listdir(log_dir)) == [
+        "completed_preprocessing.feather",
+        "completed_preprocessing.tsv",
+    ]
+
+
+def test_load_log_cached(log_dir, monkeypatch):
+    load_log(log_dir)
+
+    # unchanged log is read from the cache
+    def fail_read(*args, **kwargs):
+        raise AssertionError("log parsed again")
+
+    monkeypatch.setattr(pd, "read_csv", fail_read)
+    df_log = load_log(log_dir, columns=["subjID"])
+    assert list(df_log.columns) == ["subjID"]
+    assert df_log["subjID"].tolist() == ["sub-1", "sub-2"]
+
+
+def test_load_log_refresh(log_dir):
+    log_tsv = os.path.join(log_dir, "completed_preprocessing.tsv")
+    log_feather = os.path.join(log_dir, "completed_preprocessing.feather")
+    load_log(log_dir)
+
+    # log updated while the cache was written, the cache is newer
+    with open(log_tsv, "a") as h_file:
+        h_file.write("sub-3\t1\n")
+    _set_mtime(log_tsv, 1_000_000)
+    _set_mtime(log_feather, 2_000_000)
+    assert load_log(log_dir)["subjID"].tolist() == ["sub-1", "sub-2", "sub-3"]
+
+    # log of the same size with a new mtime
+    with open(log_tsv, "w") as h_file:
+        h_file.write("subjID\treface\nsub-4\t1\nsub-5\t\nsub-6\t1\n")
+    _set_mtime(log_tsv, 1_000_000)
+    assert load_log(log_dir)["subjID"].tolist() == ["sub-1", "sub-2", "sub-3"]
+    _set_mtime(log_tsv, 1_000_001)
+    assert load_log(log_dir)["subjID"].tolist() == ["sub-4", "sub-5", "sub-6"]
+
+
+def test_load_log_corrupt_cache(log_dir):
+    log_feather = os.path.join(log_dir, "completed_preprocessing.feather")
+    with open(log_feather, "w") as h_file:
+        h_file.write("truncated")
+    _set_mtime(log_feather, 4_000_000_000)
+
+    df_log = load_log(log_dir, columns=["subjID", "reface"])
+    assert df_log["subjID"].tolist() == ["sub-1", "sub-2"]
+    assert df_log["reface"].isnull().tolist() == [False, True]
+    assert load_log(log_dir)["subjID"].tolist() == ["sub-1", "sub-2"]
+    assert not [x for x in os.listdir(log_dir) if x.endswith(".tmp")]
+
+
+# %%
+def test_index_decon_plans():
+    json_index = index_decon_plans(
+        [
+            "sub-123_decon.json",
+            "sub-12_decon.json",
+            "sub-12_decon-old.json",
+            "sub-4.json",
+            "sub-5_timing.txt",
+            "notes.json",
+        ]
+    )
+    assert json_index == {
+        "sub-12": "sub-12_decon-old.json",
+        "sub-123": "sub-123_decon.json",
+        "sub-4": "sub-4.json",
+    }
+    assert "sub-1" not in json_index
+
+
+# %%
+def _start_job(tmp_path, log_path, job_lines):
+    """Start python running job_lines after log_to_local(log_path)."""
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    job_script = "\n".join(
+        [
+            "import os, signal, sys, time, subprocess",
+            "from func_processing.cli._joblog import log_to_local",
+            f"log_to_local({str(log_path)!r})",
+        ]
+        + job_lines
+    )
+    repo_dir = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+    h_env = dict(os.environ, TMPDIR=str(tmp_path), PYTHONPATH=repo_dir)
+    h_env.pop("SLURM_TMPDIR", None)
+    return subprocess.Popen(
+        [sys.executable, "-c", job_script],
+        env=h_env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+
+def _read_log(log_path):
+    with gzip.open(f"{log_path}.gz", "rt") as h_log:
+        return h_log.read()
+
+
+def test_log_to_local_sigterm(tmp_path):
+    log_path = tmp_path / "slurm_out" / "out_sub-1.txt"
+    job_run = _start_job(
+        tmp_path,
+        log_path,
+        [
+            "print('from python')",
+            "subprocess.run(['echo', 'from child'])",
+            "os.kill(os.getpid(), signal.SIGTERM)",
+            "print('not reached')",
+        ],
+    )
+    h_out, _ = job_run.communicate(timeout=60)
+
+    assert job_run.returncode == -signal.SIGTERM
+    assert b"Job log written to" in h_out
+    assert not [x for x in os.listdir(tmp_path) if x.startswith("out_sub-1")]
+    log_text = _read_log(log_path)
+    assert "from python" in log_text
+    assert "from child" in log_text
+    assert "not reached" not in log_text
+
+
+def test_log_to_local_concurrent(tmp_path):
+    # jobs of the same subject on one node, each with its own slurm_dir
+    log_a = tmp_path / "slurm_a" / "out_sub-1.txt"
+    log_b = tmp_path / "slurm_b" / "out_sub-1.txt"
+    flag_b = tmp_path / "b_done"
+
+    job_a = _start_job(
+        tmp_path,
+        log_a,
+        [
+            "print('job a start', flush=True)",
+            f"while not os.path.exists({str(flag_b)!r}):",
+            "    time.sleep(0.05)",
+            "print('job a end')",
+        ],
+    )
+    job_b = _start_job(
+        tmp_path,
+        log_b,
+        ["print('job b')", f"open({str(flag_b)!r}, 'w').close()"],
+    )
+    _, err_b = job_b.communicate(timeout=60)
+    _, err_a = job_a.communicate(timeout=60)
+
+    assert job_a.returncode == 0, err_a.decode()
+    assert job_b.returncode == 0, err_b.decode()
+    assert _read_log(log_a).split() == ["job", "a", "start", "job", "a", "end"]
+    assert _read_log(log_b).split() == ["job", "b"]
+    assert not [x for x in os.listdir(tmp_path) if x.startswith("out_sub-1")]
@@ -58,8 +58,10 @@ def control_fmriprep(subj, proj_dir, scratch_dir, sing_img, tplflow_dir, fs_lice
     t1_list = sorted(glob.glob(f"{subj_scratch_dset}/**/*T1w.nii.gz", recursive=True))
     if not t1_list:
         print(f"\nCopying {subj} dset to {scratch_dset} ...\n")
-        h_cmd = f"cp -r {dset_dir}/{subj} {scratch_dset}/"
-        h_cp = subprocess.Popen(h_cmd, shell=True, stdout=subprocess.PIPE)
+        h_cp = subprocess.Popen(
+            ["cp", "-r", os.path.join(dset_dir, subj), f"{scratch_dset}/"],
+            stdout=subprocess.PIPE,
+        )
         h_cp.communicate()
         t1_list = sorted(
             glob.glob(f"{subj_scratch_dset}/**/*T1w.nii.gz", recursive=True)